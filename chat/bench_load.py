@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Load test of the chat stack. Starts a server on localhost and connects
+synthetic headless clients, spread over several worker processes, that send
+messages at a fixed rate while measuring when every message is delivered.
+
+The results are printed as JSON, one entry per engine: connect time,
+throughput, end to end delivery latency and server memory. Given the JSON
+of a previous run with --baseline, the exit status tells whether any engine
+got slower than the tolerance allows, so it can be used as a regression
+benchmark.
+
+The sharded engine is run once for every number of shards given with -k,
+reported as sharded-K, to see how throughput grows with the cores used.
+"""
+from multiprocessing.connection import Client
+from multiprocessing import Process, Queue, Barrier
+from time import sleep, time, perf_counter
+import json, os, subprocess, sys, tempfile
+
+from messages import *
+from metrics import Histogram
+from client import ChatClient
+
+LATENCY_RESOLUTION = 32 # Histogram buckets per octave, about 2% wide
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+class LoadClient(ChatClient):
+    """
+    Headless client that keeps no history, it only measures how long the
+    messages of the others took to arrive.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latency = Histogram(LATENCY_RESOLUTION)
+        self.received = 0
+
+    def update_history(self, message):
+        if message.type == MESSAGE_HISTORY:
+            return
+        now = time()
+        for inner in unpack_messages(message):
+            if inner.type == MESSAGE:
+                self.latency.record(now - inner.timestamp.timestamp())
+                self.received += 1
+
+def run_worker(port, usernames, args, barrier, results):
+    clients = []
+    connect = Histogram(LATENCY_RESOLUTION)
+    for username in usernames:
+        client = LoadClient(username, port = port)
+        start = perf_counter()
+        if client.open():
+            connect.record(perf_counter() - start)
+            clients.append(client)
+    barrier.wait() # Everybody is connected
+    text = "x" * args.size
+    interval = 1 / (args.rate * len(clients)) if clients else args.duration
+    start = perf_counter()
+    sent = 0
+    while perf_counter() - start < args.duration and clients:
+        client = clients[sent % len(clients)]
+        message = Message(type=MESSAGE, username=client.username, message=text)
+        client.send_frame(encode_frame(message, client.wire))
+        sent += 1
+        delay = start + sent * interval - perf_counter()
+        if delay > 0:
+            sleep(delay)
+    barrier.wait() # Everybody is done sending
+    sleep(args.drain)
+    latency = Histogram(LATENCY_RESOLUTION)
+    received = 0
+    for client in clients:
+        client.close()
+        latency.merge(client.latency)
+        received += client.received
+    results.put({ "connected" : len(clients), "sent" : sent,
+                  "received" : received, "connect" : connect,
+                  "latency" : latency })
+
+def wait_for_server(port, timeout = 10):
+    deadline = time() + timeout
+    while time() < deadline:
+        try:
+            Client(("127.0.0.1", port), authkey=b"secret password").close()
+            return True
+        except ConnectionRefusedError:
+            sleep(0.05)
+    return False
+
+def server_rss_kb(pid):
+    """
+    Resident memory of a process and its children, which is where the
+    process engine keeps its clients
+    """
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f"/proc/{pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+            with open(f"/proc/{pid}/task/{pid}/children") as children:
+                pids += [int(child) for child in children.read().split()]
+        except OSError:
+            pass
+    return total
+
+def run_engine(engine, port, args, shards = None):
+    workdir = tempfile.mkdtemp(prefix="bench_load_") # Fresh server.db
+    command = [sys.executable, SERVER, "-e", engine, "-p", str(port), "-l", "off"]
+    if shards:
+        command += ["-k", str(shards)]
+    server = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL)
+    try:
+        if not wait_for_server(port):
+            raise RuntimeError(f"The {engine} server didn't start")
+        barrier = Barrier(args.workers + 1, timeout = args.duration + 120)
+        results = Queue()
+        workers = []
+        for i in range(args.workers):
+            usernames = [f"load{j}" for j in range(i, args.clients, args.workers)]
+            worker = Process(target=run_worker,
+                             args=(port, usernames, args, barrier, results))
+            worker.start()
+            workers.append(worker)
+        start = perf_counter()
+        barrier.wait()
+        connected_in = perf_counter() - start
+        barrier.wait()
+        rss = server_rss_kb(server.pid)
+        stats_client = ChatClient("bench_stats", port = port)
+        stats = stats_client.stats() if stats_client.open() else None
+        stats_client.close()
+        connect = Histogram(LATENCY_RESOLUTION)
+        latency = Histogram(LATENCY_RESOLUTION)
+        connected = sent = received = 0
+        for _ in workers:
+            result = results.get()
+            connected += result["connected"]
+            sent += result["sent"]
+            received += result["received"]
+            connect.merge(result["connect"])
+            latency.merge(result["latency"])
+        for worker in workers:
+            worker.join()
+    finally:
+        server.terminate()
+        server.wait()
+    expected = sent * (connected - 1)
+    return { "clients"          : connected,
+             "connect_all_s"    : round(connected_in, 3),
+             "connect_us"       : connect.summary(),
+             "sent"             : sent,
+             "sent_per_s"       : round(sent / args.duration, 1),
+             "delivered"        : received,
+             "delivered_ratio"  : round(received / expected, 4) if expected else None,
+             "throughput"       : round(received / args.duration, 1),
+             "latency_us"       : latency.summary(),
+             "server_rss_kb"    : rss,
+             "server_stats"     : stats }
+
+def regressions(results, baseline, tolerance):
+    """
+    Messages describing the engines that are worse than in baseline
+    """
+    found = []
+    for engine, result in results.items():
+        old = baseline.get("engines", {}).get(engine)
+        if not old:
+            continue
+        if result["throughput"] < old["throughput"] * (1 - tolerance):
+            found.append(f"{engine}: throughput {result['throughput']}"
+                         f" < {old['throughput']}")
+        for p in ("p50", "p99"):
+            new_p, old_p = result["latency_us"].get(p), old["latency_us"].get(p)
+            if new_p and old_p and new_p > old_p * (1 + tolerance):
+                found.append(f"{engine}: latency {p} {new_p} > {old_p}")
+    return found
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="chat load benchmark")
+    parser.add_argument("-e", metavar="engine", nargs="+", default=["process", "async"],
+                        choices=["process", "async", "sharded"],
+                        help="server engines to test")
+    parser.add_argument("-k", metavar="shards", nargs="+", default=[2], type=int,
+                        help="numbers of shards to test the sharded engine with")
+    parser.add_argument("-p", metavar="port", default=6100,
+                        help="first server port, one more for every engine", type=int)
+    parser.add_argument("-n", dest="clients", metavar="clients", default=50,
+                        help="synthetic clients", type=int)
+    parser.add_argument("-w", dest="workers", metavar="workers", default=4,
+                        help="processes the clients are spread over", type=int)
+    parser.add_argument("-r", dest="rate", metavar="rate", default=1.0,
+                        help="messages per second sent by every client", type=float)
+    parser.add_argument("-d", dest="duration", metavar="seconds", default=10.0,
+                        help="sending time", type=float)
+    parser.add_argument("-s", dest="size", metavar="bytes", default=80,
+                        help="message length", type=int)
+    parser.add_argument("--drain", metavar="seconds", default=1.0,
+                        help="time to wait for deliveries after sending", type=float)
+    parser.add_argument("-o", metavar="file", default=None,
+                        help="write the JSON results here too", type=str)
+    parser.add_argument("--baseline", metavar="file", default=None,
+                        help="JSON of a previous run to compare with", type=str)
+    parser.add_argument("--tolerance", metavar="fraction", default=0.2,
+                        help="allowed regression against the baseline", type=float)
+    args = parser.parse_args()
+    args.workers = max(1, min(args.workers, args.clients))
+    config = { key : getattr(args, key)
+               for key in ("clients", "workers", "rate", "duration", "size") }
+    runs = []
+    for engine in args.e:
+        if engine == "sharded":
+            runs += [(f"sharded-{k}", engine, k) for k in args.k]
+        else:
+            runs.append((engine, engine, None))
+    results = {}
+    for i, (name, engine, shards) in enumerate(runs):
+        results[name] = run_engine(engine, args.p + i, args, shards)
+    output = json.dumps({ "config" : config, "engines" : results }, indent=2)
+    print(output)
+    if args.o:
+        with open(args.o, "w") as f:
+            f.write(output + "\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print(f"[REGRESSION] {regression}", file=sys.stderr)
+        sys.exit(1 if found else 0)
+
+if __name__ == "__main__":
+    main()
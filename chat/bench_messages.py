@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of message construction, encoding and decoding. Prints the
+cost per message in microseconds.
+"""
+from timeit import repeat
+
+from messages import *
+
+def per_message(stmt, n):
+    return min(repeat(stmt, number=n, repeat=5)) / n * 1e6
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="messages benchmark")
+    parser.add_argument("-n", metavar="messages", default=20000,
+                        help="messages per measure", type=int)
+    args = parser.parse_args()
+    message = Message(type=MESSAGE, username="username", message="x" * 80)
+    payload = message.encode()
+    pickled = encode_frame(message, 0)
+    binary = encode_frame(message, WIRE_VERSION)
+    results = {
+        "Message(type=...)"       : lambda: Message(type=MESSAGE, username="username",
+                                                    message="x" * 80),
+        "Message(payload=...)"    : lambda: Message(payload=dict(payload)),
+        "encode_frame (pickle)"   : lambda: encode_frame(message, 0),
+        "encode_frame (binary)"   : lambda: encode_frame(message, WIRE_VERSION),
+        "decode_frame (pickle)"   : lambda: decode_frame(pickled),
+        "decode_frame (binary)"   : lambda: decode_frame(binary),
+        "code_to_type"            : lambda: code_to_type(MESSAGE_BATCH['code']),
+        }
+    for name, stmt in results.items():
+        print(f"{name:25} {per_message(stmt, args.n):8.3f} us")
+
+if __name__ == "__main__":
+    main()
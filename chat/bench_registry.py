@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Messages per second through the broadcast path of the server with the old
+Manager backed client registry and with the in-process ClientRegistry.
+
+For every message the sender's membership is checked (as the receive loop
+does) and a frame is queued for every other client (as broadcast_message
+does).
+"""
+from multiprocessing import Manager
+from queue import Queue
+from time import perf_counter
+
+from messages import *
+from server import ClientRegistry
+
+def fan_out(clients, messages):
+    usernames = list(clients)
+    start = perf_counter()
+    for i in range(messages):
+        sender = usernames[i % len(usernames)]
+        assert sender in clients
+        message = Message(type=MESSAGE, username=sender, message=f"message {i}")
+        for username, data in clients.items():
+            if username != sender:
+                data["queue"].put_nowait(message.encode())
+    return messages / (perf_counter() - start)
+
+def manager_registry(manager, n):
+    clients = manager.dict()
+    for i in range(n):
+        clients[f"user{i}"] = { "queue" : manager.Queue(), "ip" : "127.0.0.1" }
+    return clients
+
+def local_registry(n):
+    clients = ClientRegistry()
+    for i in range(n):
+        clients[f"user{i}"] = { "queue" : Queue(), "ip" : "127.0.0.1" }
+    return clients
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="client registry benchmark")
+    parser.add_argument("-n", metavar="clients", default=128,
+                        help="simulated clients", type=int)
+    parser.add_argument("-m", metavar="messages", default=200,
+                        help="messages broadcast", type=int)
+    args = parser.parse_args()
+    with Manager() as manager:
+        before = fan_out(manager_registry(manager, args.n), args.m)
+    after = fan_out(local_registry(args.n), args.m)
+    print(f"{args.n} clients, {args.m} messages")
+    print(f"Manager().dict() registry: {before:10.1f} messages/s")
+    print(f"ClientRegistry:            {after:10.1f} messages/s")
+
+if __name__ == "__main__":
+    main()
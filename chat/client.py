@@ -1,27 +1,64 @@
 #!/usr/bin/env python3
-from multiprocessing.connection import Client
-from multiprocessing import Process, Manager, Lock
+from multiprocessing.connection import Client, wait
+from multiprocessing import Pipe
+from threading import Thread, Lock, Event
 from datetime import datetime
-import logging
+import json, logging, sqlite3
 
 from messages import *
 from client_ui import *
+from client_cache import *
 
 class ChatClient():
+    """
+    Chat client running in a single process: the connection, a local history
+    and a thread that receives messages.
+
+    Without a ui it can be used as a library, by bots or load generators,
+    through open(), send_message() and close(). Subclasses can override
+    update_history to be told about every received message. With ui=True
+    the curses ChatClientUI is drawn on top.
+
+    With compress the server is asked to send the history and batches of
+    messages compressed.
+
+    With a cache_dir the chat messages are also kept in a ClientCache, so
+    the next run starts with them and only asks the server for newer ones.
+
+    The client is always in DEFAULT_CHANNEL and can join() others, which are
+    joined again when reconnecting. Messages typed in the ui go to the last
+    channel joined, the ui commands are /join channel and /leave channel.
+    """
+
     def __init__(self, username, ip="127.0.0.1", port=6000,\
-            authkey=b"secret password"):
+            authkey=b"secret password", ui=False, cache_dir=None, compress=True):
         self.username = username
         self.addr     = (ip, int(port))
         self.authkey  = authkey
+        self.compress = compress
 
         self.conn     = None
-        self.manager  = Manager()
-        self.history  = MessageHistory(manager = self.manager)
+        self.wire     = 0
+        self.history  = MessageHistory(capacity = HISTORY_CAPACITY)
+        self.channels = {DEFAULT_CHANNEL}
+        self.channel  = DEFAULT_CHANNEL # Where send_message writes by default
 
-        self.sender   = None
         self.receiver = None
-        self.lock     = Lock()
-        self.ui      = ChatClientUI(self.username, self.history)
+        self.lock     = Lock() # History and ui, shared with the receiver
+        # Written to on close() to wake up the receiver
+        self.wakeup_r, self.wakeup_w = Pipe(duplex = False)
+        self.ui       = ChatClientUI(self.username, self.history,
+                                     lock = self.lock) if ui else None
+        self.server_stats = None # Last STATS received
+        self.stats_ready  = Event()
+        self.search_result = None # Last SEARCH_RESULT received
+        self.search_ready = Event()
+        self.cache    = None
+        if cache_dir:
+            try:
+                self.cache = ClientCache(cache_dir, self.addr)
+            except (OSError, sqlite3.Error) as e:
+                print(f"[ERROR] Not using the cache: {e}")
 
     def log(self, msg, **args):
         level = args.get('level', 'debug')
@@ -32,105 +69,228 @@ class ChatClient():
 
     def start(self):
         """
-        Create connection and processes for sending and receiving messages
+        Open the connection and run until it is closed, reading messages from
+        the ui if there is one.
         """
         self.log(f"STARTING CLIENT (username: {self.username})", level = 'info')
+        if self.open():
+            if self.ui:
+                with self.lock:
+                    self.ui.start()
+                self._send_loop()
+            else:
+                self.receiver.join()
+        else:
+            self.stop()
+
+    def open(self):
+        """
+        Connect to the server and start the receiver thread. False if the
+        connection was refused.
+        """
         try:
             self.conn = Client(address=self.addr, authkey=self.authkey)
         except Exception as e:
             print(f"[ERROR] {e}")
-        else:
-            self.receiver = Process(target=self._receive_loop,
-                                    name=f"{self.username} receiver")
-            self.sender = Process(target=self._send_loop,
-                                    name=f"{self.username} sender")
-            if self.connect():
-                self.ui.start()
-                self.sender.start()
-                self.receiver.start()
-                self.sender.join()
-                self.receiver.join()
-            else:
-                self.stop()
+            return False
+        nodelay(self.conn)
+        if self.cache and not len(self.history):
+            self.history.merge(self.cache.load())
+        if not self.connect():
+            return False
+        for channel in self.channels - {DEFAULT_CHANNEL}:
+            self._send_join(channel)
+        self.receiver = Thread(target=self._receive_loop,
+                               name=f"{self.username} receiver")
+        self.receiver.daemon = True
+        self.receiver.start()
+        return True
 
     def connect(self):
         # self.log("STARTING CONNECT")
         try:
-            message = Message(type = CONNECT, username = self.username)
-            self.send_payload(message.encode())
-            response = self.conn.recv()
-            history = response.get('history')
-            for message in decode_history(history):
-                self.append_history(message)
-        except ValueError as e:
+            message = Message(type = CONNECT, username = self.username,
+                              wire = WIRE_VERSION, since = self.last_seen(),
+                              compress = ZLIB if self.compress else 0)
+            self.send_frame(encode_frame(message))
+            frame = self.conn.recv_bytes()
+            response = decode_frame(frame)
+        except (EOFError, ValueError) as e:
             # self.log(e)
             return False
         else:
-            if response['type_code'] == ERROR['code']:
-                response = Message(payload = response)
+            if frame[:1] == FRAME_MAGIC:
+                self.wire = frame[1] # The version the server agreed to
+            if response.type == ERROR:
                 message = response.get('message')
                 critical = response.get('critical')
                 print(f"[ERROR] {message}")
                 if critical:
                     return False
+            else:
+                self.append_history(response)
             return True
 
-    def stop(self):
-        try:
-            if type(self.sender) is Process:
-                self.sender.terminate()
-            if type(self.receiver) is Process:
-                self.receiver.terminate()
-        except:
-            pass
-        finally:
-            self.ui.stop()
-            import sys
-            sys.exit()
+    def close(self):
+        """
+        Stop the receiver and say goodbye to the server
+        """
+        if self.receiver and self.receiver.is_alive():
+            self.wakeup_w.send_bytes(b'')
+            self.receiver.join()
         if self.conn:
-            self.send_payload(CLOSE)
+            self.send_frame(encode_frame(Message(type = CLOSE), self.wire))
             self.conn.close()
             self.conn = None
+        if self.cache:
+            self.cache.flush()
+
+    def stop(self):
+        self.close()
+        if self.cache:
+            self.cache.close()
+            self.cache = None
+        if self.ui:
+            self.ui.stop()
 
     def _send_loop(self):
         self.log("Starting send loop")
-        self.sender
         while self.conn:
             message = self.ui.input()
-            if len(message) > 0:
-                try:
+            command, _, channel = message.partition(" ")
+            try:
+                if command == "/join" and channel:
+                    self.join(channel)
+                elif command == "/leave" and channel:
+                    self.leave(channel)
+                elif len(message) > 0:
                     self.send_message(message)
-                except ValueError as e:
-                    self.log(e)
+            except ValueError as e:
+                self.log(e)
 
     def _receive_loop(self):
         self.log("Starting receive loop")
-        while self.conn:
-            if self.conn.poll():
-                try:
-                    message = Message(payload = self.conn.recv())
-                    self.update_history(message)
-                except Exception as e:
-                    self.log(f"Error receiving message: {e}")
+        while True:
+            # Sleep until the server sends something or close() is called
+            if self.wakeup_r in wait([self.conn, self.wakeup_r]):
+                self.wakeup_r.recv_bytes()
+                break
+            try:
+                message = decode_frame(self.conn.recv_bytes())
+            except EOFError:
+                self.log("Connection closed by the server")
+                break
+            except Exception as e:
+                self.log(f"Error receiving message: {e}")
+            else:
+                self.update_history(message)
+
+    def last_seen(self, channel = DEFAULT_CHANNEL):
+        """
+        Epoch microseconds of the newest chat message of a channel in the
+        history, 0 if there is none.
+        """
+        for message in reversed(self.history):
+            if message.type == MESSAGE and message.get('channel') == channel:
+                return message.epoch_us
+        return 0
+
+    def join(self, channel):
+        """
+        Join a channel, the server answers with its history. It becomes the
+        channel send_message writes to.
+        """
+        self.channels.add(channel)
+        self.channel = channel
+        self._send_join(channel)
+
+    def leave(self, channel):
+        if channel == DEFAULT_CHANNEL:
+            raise ValueError(f"Can't leave {DEFAULT_CHANNEL}")
+        self.channels.discard(channel)
+        if self.channel == channel:
+            self.channel = DEFAULT_CHANNEL
+        self.send_frame(encode_frame(Message(type = LEAVE, channel = channel),
+                                     self.wire))
+
+    def _send_join(self, channel):
+        with self.lock:
+            since = self.last_seen(channel)
+        message = Message(type = JOIN, channel = channel, since = since)
+        self.send_frame(encode_frame(message, self.wire))
 
     def append_history(self, message):
-        self.lock.acquire()
-        self.history.add(message)
-        self.lock.release()
+        with self.lock:
+            self._append(message)
+
+    def _append(self, message):
+        if message.type == MESSAGE_BATCH:
+            for inner in message.get('messages'):
+                self._append(inner)
+        elif message.type == STATS:
+            self.server_stats = json.loads(message.get('stats'))
+            self.stats_ready.set()
+        elif message.type == SEARCH_RESULT:
+            self.search_result = message
+            self.search_ready.set()
+        elif message.type == MESSAGE_HISTORY:
+            history = message.get('history')
+            self.history.merge(history)
+            if self.cache:
+                self.cache.add_history(history)
+        else:
+            self.history.add(message)
+            if self.cache:
+                self.cache.add([message])
 
     def update_history(self, message):
-        self.append_history(message)
-        self.ui.redraw()
+        with self.lock:
+            self._append(message)
+            if self.ui:
+                if message.type == MESSAGE_HISTORY:
+                    self.ui.update()
+                else:
+                    self.ui.update(unpack_messages(message))
+
+    def stats(self, timeout = 5):
+        """
+        Ask the server for its metrics. None if they don't arrive in time.
+        """
+        self.stats_ready.clear()
+        self.send_frame(encode_frame(Message(type = STATS), self.wire))
+        if self.stats_ready.wait(timeout):
+            return self.server_stats
+        return None
+
+    def search(self, query, username = '', channel = '', since = None,
+               until = None, page = 0, timeout = 5):
+        """
+        Search the messages stored by the server with the words of query,
+        a word ending in * matches the words that start with it. since and
+        until are datetimes. Returns a page of matching messages, best
+        ranked first, and whether there are more pages. None if the answer
+        doesn't arrive in time.
+        """
+        message = Message(type = SEARCH, query = query, username = username,
+                          channel = channel, page = page,
+                          since = to_epoch_us(since) if since else 0,
+                          until = to_epoch_us(until) if until else 0)
+        self.search_ready.clear()
+        self.send_frame(encode_frame(message, self.wire))
+        if self.search_ready.wait(timeout):
+            return self.search_result.get('results'), self.search_result.get('more')
+        return None
 
-    def send_message(self, message):
+    def send_message(self, message, channel = None):
         self.log(f"{message}", level='info')
-        message = Message(type=MESSAGE, username = self.username, message = message)
+        message = Message(type=MESSAGE, username = self.username, message = message,
+                          channel = channel or self.channel)
         self.update_history(message)
-        self.send_payload(message.encode())
+        self.send_frame(encode_frame(message, self.wire))
 
-    def send_payload(self, payload):
+    def send_frame(self, frame):
         try:
-            self.conn.send(payload)
+            self.conn.send_bytes(frame)
             # response = self.conn.recv()
         except Exception as e:
             self.log(f"Error sending message: {e}")
@@ -145,6 +305,9 @@ if __name__ == "__main__":
                         help="server ip", type=str)
     parser.add_argument("-p", metavar="port", default=6000,
                         help="server port", type=int)
+    parser.add_argument("-c", metavar="cache_dir", default=None,
+                        help="keep the history of the server in this directory",
+                        type=str)
     parser.add_argument('-l', dest='logging', action='store_true')
     args = parser.parse_args()
     if not args.u:
@@ -153,7 +316,8 @@ if __name__ == "__main__":
         FORMAT = '%(asctime)s:%(levelname)s:%(process)d:%(message)s'
         logging.basicConfig(filename='client.log', format=FORMAT, level=logging.DEBUG)
     try:
-        client = ChatClient(args.u, args.i, args.p)
+        client = ChatClient(args.u, args.i, args.p, ui = True,
+                            cache_dir = args.c)
         client.start()
     except KeyboardInterrupt:
         client.stop()
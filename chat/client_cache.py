@@ -0,0 +1,129 @@
+import os, sqlite3
+from threading import Lock
+
+from messages import *
+
+CACHE_SIZE = 10 * HISTORY_CAPACITY # Messages kept on disk per server
+CACHE_FLUSH_SIZE = 256 # Buffered messages that trigger a write
+
+class ClientCache():
+    """
+    Chat messages of a server kept on disk between runs, in an SQLite
+    database per server address, so that the client only has to ask the
+    server for the newer ones.
+
+    Messages are buffered and written in a single transaction when
+    CACHE_FLUSH_SIZE are waiting or on close. The histories sent by the
+    server wait for flush, so their messages aren't decoded as they
+    arrive. The ones lost in a crash are just downloaded again.
+    """
+
+    def __init__(self, directory, addr):
+        ip, port = addr
+        os.makedirs(directory, exist_ok = True)
+        self.db_file = os.path.join(directory, f"{ip}_{port}.db")
+        self.lock = Lock() # Serializes the use of the connection
+        self.pending = []
+        self.histories = []
+        self.history_size = 0 # Messages in histories
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS messages (
+                timestamp integer NOT NULL,
+                username text NOT NULL,
+                body text NOT NULL,
+                channel text NOT NULL,
+                PRIMARY KEY (timestamp, username, body)
+                ) WITHOUT ROWID;""")
+        columns = [row[1] for row in
+                   self.conn.execute("PRAGMA table_info(messages);")]
+        if 'channel' not in columns:
+            # Caches written before channels existed
+            self.conn.execute(f"""ALTER TABLE messages ADD COLUMN channel text
+                    NOT NULL DEFAULT '{DEFAULT_CHANNEL}';""")
+        self.conn.commit()
+
+    def load(self, n = HISTORY_CAPACITY):
+        """
+        History with the newest n cached messages, decoded lazily
+        """
+        with self.lock:
+            rows = self.conn.execute("""SELECT timestamp, username, body, channel
+                    FROM messages ORDER BY timestamp DESC LIMIT ?;""",
+                    (n,)).fetchall()
+        rows.reverse()
+        return MessageHistory(messages = LazyMessages(rows, cached_message))
+
+    def add(self, messages):
+        """
+        Buffer chat messages to be written to the cache
+        """
+        rows = [(message.epoch_us, message.get('username'),
+                 message.get('message'), message.get('channel'))
+                for message in messages if message.type == MESSAGE]
+        with self.lock:
+            self.pending += rows
+            n = len(self.pending)
+        if n >= CACHE_FLUSH_SIZE:
+            self._write()
+
+    def add_history(self, history):
+        """
+        Keep a history to be written on flush. Once CACHE_SIZE messages are
+        waiting the rest are left out: the pages of a history arrive newest
+        first, so those would mostly be trimmed on close anyway.
+        """
+        with self.lock:
+            if self.history_size < CACHE_SIZE:
+                self.histories.append(history)
+                self.history_size += len(history)
+
+    def flush(self):
+        """
+        Write what is buffered, histories included
+        """
+        with self.lock:
+            histories, self.histories = self.histories, []
+            self.history_size = 0
+        for history in histories:
+            self.add(reversed(history))
+        self._write()
+
+    def _write(self):
+        with self.lock:
+            rows, self.pending = self.pending, []
+            if rows:
+                try:
+                    self.conn.executemany("""INSERT OR IGNORE INTO
+                            messages(timestamp, username, body, channel)
+                            VALUES(?,?,?,?);""", rows)
+                    self.conn.commit()
+                except sqlite3.Error as e:
+                    self.conn.rollback()
+                    print("sqlite3.Error:",e)
+
+    def close(self):
+        """
+        Write what is buffered, forget all but the newest CACHE_SIZE messages
+        and close the database
+        """
+        self.flush()
+        with self.lock:
+            try:
+                self.conn.execute("""DELETE FROM messages WHERE timestamp <
+                        (SELECT timestamp FROM messages
+                         ORDER BY timestamp DESC LIMIT 1 OFFSET ?);""",
+                        (CACHE_SIZE - 1,))
+                self.conn.commit()
+            except sqlite3.Error as e:
+                print("sqlite3.Error:",e)
+            self.conn.close()
+
+def cached_message(row):
+    """
+    Message stored in a row of the cache
+    """
+    timestamp, username, body, channel = row
+    return Message(type = MESSAGE, username = username, message = body,
+                   channel = channel, timestamp = timestamp)
@@ -1,14 +1,27 @@
-import os
+from threading import Lock, Timer
+from time import monotonic
 import curses, curses.textpad
 
 from messages import *
 
+MAX_FPS = 30 # Frames drawn per second at most, however fast messages arrive
+
 class ChatClientUI():
-    def __init__(self, username, history, debug = False):
+    def __init__(self, username, history, debug = False, lock = None):
         self.username = username
         self.history = history
+        self.lock = lock or Lock() # Held while drawing from input()
+        self.size = None # (rows, cols), updated on KEY_RESIZE
         self.history_window = None
+        self.lines_window = None
         self.prompt_window = None
+        # Frames: messages waiting to be drawn, the newest one drawn or
+        # pending, and whether everything has to be drawn again
+        self.pending = []
+        self.newest = None
+        self.full_redraw = False
+        self.frame_timer = None
+        self.last_frame = 0
         self.debug = debug
         if self.debug:
             self.debug_window = None
@@ -29,11 +42,14 @@ class ChatClientUI():
         assert self.screen == None, "Curses is already running"
         self.screen = curses.initscr()
         curses.cbreak()
+        curses.noecho() # input() echoes by itself
         self.screen.keypad(1)
+        self.size = (curses.LINES, curses.COLS)
 
     def _stop_curses(self):
         if self.screen is not None:
             curses.nocbreak()
+            curses.echo()
             self.screen.keypad(0)
             self.screen = None
             curses.endwin()
@@ -43,45 +59,131 @@ class ChatClientUI():
         self.redraw_history()
         self.redraw_prompt()
 
+    def resize(self):
+        """
+        Fit the windows to the terminal. curses reports a SIGWINCH as a
+        KEY_RESIZE key, after updating its own idea of the size.
+        """
+        curses.update_lines_cols()
+        self.size = rows, cols = (curses.LINES, curses.COLS)
+        self.screen.clear()
+        self.init_history_window()
+        self.prompt_window.resize(1, cols)
+        self.prompt_window.mvwin(rows-1, 0)
+        if self.debug:
+            self.debug_window.resize(rows-1, cols//2+1)
+        self.redraw()
+
     def init_history_window(self):
-        rows, cols = ChatClientUI.terminal_size()
+        rows, cols = self.size
         if self.debug:
             cols = cols//2
         self.history_window = curses.newwin(rows-1, cols, 0, 0)
+        # The messages are drawn in a window inside the border, which can be
+        # scrolled on its own
+        self.lines_window = curses.newwin(rows-3, cols-2, 1, 1)
+        self.lines_window.scrollok(True)
+
+    def update(self, messages = None):
+        """
+        Draw messages newer than the ones shown, or the whole history if
+        messages is None. Updates are coalesced into at most MAX_FPS frames
+        per second. Must be called with the lock held.
+        """
+        if messages is None or self.full_redraw:
+            self.full_redraw = True
+        else:
+            for message in messages:
+                if not ChatClientUI.format_message(message):
+                    continue
+                if self.newest and message < self.newest:
+                    self.full_redraw = True # Not at the bottom, redraw all
+                    break
+                self.pending.append(message)
+                self.newest = message
+        if self.frame_timer is None:
+            delay = self.last_frame + 1 / MAX_FPS - monotonic()
+            if delay > 0:
+                self.frame_timer = Timer(delay, self._timed_frame)
+                self.frame_timer.daemon = True
+                self.frame_timer.start()
+            else:
+                self._frame()
+
+    def _timed_frame(self):
+        with self.lock:
+            self.frame_timer = None
+            if self.screen is not None:
+                self._frame()
+
+    def _frame(self):
+        self.last_frame = monotonic()
+        height, width = self.lines_window.getmaxyx()
+        if self.full_redraw or len(self.pending) >= height:
+            self.redraw_history()
+        elif self.pending:
+            self.lines_window.scroll(len(self.pending))
+            row = height - len(self.pending)
+            for message in self.pending:
+                self._draw_line(row, message, width)
+                row += 1
+            self.pending.clear()
+            self.lines_window.noutrefresh()
+            self.prompt_window.noutrefresh() # Leave the cursor in the prompt
+            curses.doupdate()
 
     def redraw_history(self):
-        self.history_window.clear()
+        self.history_window.erase()
         self.history_window.border(0)
-        rows, cols = ChatClientUI.terminal_size()
-        self.history_window.resize(rows-1, cols)
-        row = rows - 3
-        i = len(self.history) - 1
-        while row >= 1 and i >= 0:
-            message = self.history.messages[i]
-            if message.type == MESSAGE:
-                timestamp = message.get('timestamp').strftime("%T")
-                username = message.get('username')
-                message = message.get('message')
-                self.history_window.move(row,1)
-                self.history_window.addstr(f"{timestamp} [{username}] {message}")
-            elif message.type == ERROR:
-                message = message.get('message')
-                # critical = message.get('critical')
-                self.history_window.move(row,1)
-                self.history_window.addstr(f"[ERROR] {message}")
-            row -= 1
-            i -= 1
-        self.history_window.refresh()
+        self.history_window.noutrefresh()
+        height, width = self.lines_window.getmaxyx()
+        lines = []
+        for message in reversed(self.history):
+            if len(lines) == height:
+                break
+            if ChatClientUI.format_message(message):
+                lines.append(message)
+        self.lines_window.erase()
+        row = height - len(lines)
+        for message in reversed(lines):
+            self._draw_line(row, message, width)
+            row += 1
+        self.newest = lines[0] if lines else None
+        self.pending.clear()
+        self.full_redraw = False
+        self.lines_window.noutrefresh()
+        self.prompt_window.noutrefresh()
+        curses.doupdate()
+
+    def _draw_line(self, row, message, width):
+        # The last column is left alone, writing there would scroll the window
+        self.lines_window.addnstr(row, 0, ChatClientUI.format_message(message),
+                                  width - 1)
+
+    @staticmethod
+    def format_message(message):
+        """
+        Line of the history for a message, None if it is not shown
+        """
+        if message.type == MESSAGE:
+            timestamp = message.get('timestamp').strftime("%T")
+            username = message.get('username')
+            channel = message.get('channel')
+            if channel != DEFAULT_CHANNEL:
+                username = f"#{channel} {username}"
+            return f"{timestamp} [{username}] {message.get('message')}"
+        elif message.type == ERROR:
+            # critical = message.get('critical')
+            return f"[ERROR] {message.get('message')}"
+        return None
 
     def init_prompt_window(self):
-        rows, cols = ChatClientUI.terminal_size()
+        rows, cols = self.size
         self.prompt_window = curses.newwin(1, cols, rows-1, 0)
         self.prompt_window.keypad(1)
         self.prompt_window.addstr(f"{self.username}> ")
 
     def redraw_prompt(self):
-        rows, cols = ChatClientUI.terminal_size()
-        self.prompt_window.resize(1, cols)
         self.prompt_window.refresh()
 
     def reset_prompt(self):
@@ -90,19 +192,48 @@ class ChatClientUI():
         self.redraw_prompt()
 
     def input(self):
-        message = str(self.prompt_window.getstr(),"utf-8")
-        self.reset_prompt()
+        """
+        Read a line from the prompt. It is read key by key, instead of with
+        getstr, so terminal resizes can be handled meanwhile.
+        """
+        chars = []
+        while True:
+            char = self.prompt_window.get_wch()
+            if char == curses.KEY_RESIZE:
+                with self.lock:
+                    self.resize()
+            elif char in ('\n', '\r', curses.KEY_ENTER):
+                break
+            elif char in (curses.KEY_BACKSPACE, '\x7f', '\b'):
+                if chars:
+                    chars.pop()
+                    with self.lock:
+                        row, col = self.prompt_window.getyx()
+                        self.prompt_window.move(row, col-1)
+                        self.prompt_window.delch()
+                        self.prompt_window.refresh()
+            elif type(char) is str and char.isprintable():
+                chars.append(char)
+                with self.lock:
+                    try:
+                        self.prompt_window.addstr(char)
+                    except curses.error:
+                        pass # Past the end of the prompt, it is still read
+                    self.prompt_window.refresh()
+        message = "".join(chars)
+        with self.lock:
+            self.reset_prompt()
         return message
 
     def init_debug_window(self):
         if self.debug:
-            rows, cols = ChatClientUI.terminal_size()
+            rows, cols = self.size
             self.debug_window = curses.newwin(rows-1, cols//2+1, 0, 0)
 
     def redraw_debug(self, debug_history):
         if self.debug:
             self.debug_window.clear()
-            rows = ChatClientUI.terminal_size()[0]
+            rows = self.size[0]
             row = rows - 3
             for message in debug_history:
                 if row < 1:
@@ -110,7 +241,3 @@ class ChatClientUI():
                 self.debug_window.move(row,1)
                 self.debug_window.addstr(f"{message}")
 
-    @staticmethod
-    def terminal_size():
-        rows, cols = os.popen("stty size", "r").read().split()
-        return (int(rows), int(cols))
@@ -1,85 +1,134 @@
 #!/usr/bin/env python3
 from datetime import datetime
+from collections import deque
 import bisect
 import json
+import pickle
+import re
+import socket
+import struct
+import zlib
+from time import time_ns
 DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
 
+# Binary frames: magic byte, wire version, type code and timestamp (epoch
+# microseconds), followed by the fields of the type in declaration order.
+# Version 2 adds MESSAGE_BATCH frames, version 3 the channel of MESSAGE and
+# version 4 COMPRESSED frames. Keys added after version 1 declare the version
+# that carries them in 'wire'.
+WIRE_VERSION = 4
+FRAME_MAGIC = b'\xc7' # Can't be confused with a pickle, which starts with \x80
+FRAME_HEADER = struct.Struct('!cBbq')
+
+ZLIB = 1 # Bit of the compress key of CONNECT for clients that accept zlib
+COMPRESS_MIN_BYTES = 1024 # Smaller frames are not worth compressing
+COMPRESS_LEVEL = 6
+MAX_FRAME_BYTES = 64 * 1024 * 1024 # Largest decompressed frame accepted
+
+HISTORY_CAPACITY = 1000 # Messages kept by bounded histories
+DEFAULT_CHANNEL = "general" # Every client is in it, older ones know no other
+
 class Message():
     """
     Inmmutable class
+
+    The fields are kept in a tuple, in the order in which the type declares
+    its keys. The timestamp is kept in epoch microseconds, its datetime and
+    the hash are computed the first time they are asked for.
     """
 
+    __slots__ = ('_schema', '_epoch_us', '_timestamp', '_values', '_hash')
+
     def __init__(self, **kwargs):
-        self._data = { 'timestamp': datetime.now() }
+        timestamp = kwargs.pop('timestamp', None)
         if 'code' in kwargs:
-            self._type = code_to_type(kwargs['code'])
-            del kwargs['code']
+            schema = schema_of(kwargs.pop('code'))
         elif 'type' in kwargs:
-            self._type = kwargs['type']
-            del kwargs['type']
+            schema = schema_of(kwargs.pop('type')['code'])
         elif 'payload' in kwargs:
-            payload = kwargs['payload']
-            del kwargs['payload']
-            self._type = code_to_type(payload['type_code'])
-            del payload['type_code']
-            timestamp = payload['timestamp']
-            if type(timestamp) is str:
-                timestamp = datetime.strptime(timestamp, DATETIME_FORMAT)
-            self._data['timestamp'] = timestamp
-            del payload['timestamp']
-            self._payload_hash = payload['hash']
-            del payload['hash']
-            for key in payload:
-                kwargs[key] = payload[key]
+            payload = kwargs.pop('payload')
+            schema = schema_of(payload.pop('type_code'))
+            timestamp = parse_timestamp(payload.pop('timestamp'))
+            payload.pop('hash', None)
+            for key, value in payload.items():
+                # Pickles can carry lone surrogates, binary frames can't
+                if type(value) is str and not _is_utf8(value):
+                    raise ValueError(f"Key {key} is not valid UTF-8")
+            kwargs.update(payload)
+            if type(kwargs.get('history')) is str:
+                kwargs['history'] = MessageHistory(messages = LazyMessages(
+                        json.loads(kwargs['history']),
+                        lambda payload: Message(payload = payload)))
+            if 'messages' in kwargs:
+                kwargs['messages'] = [Message(payload = payload)
+                                      for payload in kwargs['messages']]
         else:
             raise ValueError
-        for key in self.type['keys']:
-            key_name = key['name']
-            if key_name in kwargs:
-                assert key['type'] == type(kwargs[key_name]),\
-                        f"key {key_name} must be of type {key['type'].__name__}"
-                self._data[key_name] = kwargs[key_name]
-                del kwargs[key_name]
-            elif key['optional']:
-                    self._data[key_name] = key['default']
-            else:
-                raise ValueError(f"Required key missing: {key['name']}")
-        error_message = ""
-        for key in kwargs:
-            error_message+=f"Unknown key: {key}\n"
-        if error_message:
-            ValueError(error_message[0:-1])
-        self._data['hash'] = hash(self)
+        if timestamp is None:
+            epoch_us = time_ns() // 1000
+        elif type(timestamp) is int:
+            epoch_us, timestamp = timestamp, None
+        else:
+            epoch_us = to_epoch_us(timestamp)
+        self._init(schema, epoch_us, schema.values(kwargs), timestamp)
+
+    def _init(self, schema, epoch_us, values, timestamp = None):
+        self._schema = schema
+        self._epoch_us = epoch_us
+        self._timestamp = timestamp
+        self._values = values
+        self._hash = None
 
     @property
     def type(self):
-        return self._type
+        return self._schema.type
 
     @property
     def data(self):
-        return self._data.copy()
+        data = { 'timestamp': self.timestamp }
+        for name, value in zip(self._schema.names, self._values):
+            data[name] = value
+        data['hash'] = hash(self)
+        return data
+
+    def has(self, key):
+        return key in ('timestamp', 'hash') or key in self._schema.index
 
     def get(self, key):
-        return self.data[key]
+        if key == 'timestamp':
+            return self.timestamp
+        elif key == 'hash':
+            return hash(self)
+        try:
+            return self._values[self._schema.index[key]]
+        except KeyError:
+            raise KeyError(key)
 
     @property
     def timestamp(self):
-        return self.get('timestamp')
+        if self._timestamp is None:
+            self._timestamp = from_epoch_us(self._epoch_us)
+        return self._timestamp
+
+    @property
+    def epoch_us(self):
+        return self._epoch_us
 
     def encode(self):
         payload = {}
-        payload['type_code'] = self.type['code']
-        for key in self._data:
-            data = self._data[key]
-            if type(data) is datetime:
-                data = datetime.strftime(data, format=DATETIME_FORMAT)
-            elif type(data) is MessageHistory:
+        payload['type_code'] = self._schema.code
+        payload['timestamp'] = self.timestamp.isoformat(timespec='microseconds')
+        for name, data in zip(self._schema.names, self._values):
+            if type(data) is MessageHistory:
                 data = data.encode()
-            payload[key] = data
+            elif type(data) is list:
+                data = [message.encode() for message in data]
+            payload[name] = data
+        payload['hash'] = hash(self)
         return payload
 
     def __lt__(self, other):
-        return self.timestamp < other.timestamp
+        return self._epoch_us < other._epoch_us
 
     def __str__(self):
         result = f"type: {self.type['name']}\n"
@@ -88,54 +137,486 @@ class Message():
         return result[0:-1]
 
     def __repr__(self):
-        return f"«type {self.type['code']}, hash {hash(self)}»"
+        return f"«type {self._schema.code}, hash {hash(self)}»"
 
     def __hash__(self):
-        if 'hash' in self.data:
-            result = self.data['hash']
-        else:
-            result = self.type['code']
-            for key in self.data:
-                if key != 'hash':
-                    result = abs(hash((result, self.data[key])))
-        return result
+        if self._hash is None:
+            result = abs(hash((self._schema.code, self._epoch_us)))
+            for data in self._values:
+                if type(data) is list:
+                    data = tuple(data)
+                result = abs(hash((result, data)))
+            self._hash = result
+        return self._hash
+
+    def __getstate__(self):
+        return (self._schema.code, self._epoch_us, self._values)
+
+    def __setstate__(self, state):
+        code, epoch_us, values = state
+        self._init(schema_of(code), epoch_us, values)
+
+
+class Schema():
+    """
+    The keys of a message type compiled once: their positions in the values
+    of a message, the checks done on construction and their binary codecs.
+
+    fields maps every wire version to the (position, pack, unpack) of the
+    keys its frames carry, the rest take their default values.
+    """
+
+    __slots__ = ('type', 'code', 'names', 'index', 'keys', 'defaults', 'fields')
+
+    def __init__(self, TYPE):
+        self.type = TYPE
+        self.code = TYPE['code']
+        self.names = tuple(key['name'] for key in TYPE['keys'])
+        self.index = { name : i for i, name in enumerate(self.names) }
+        self.keys = tuple((key['name'], key['type'], key['optional'], key.get('default'))
+                          for key in TYPE['keys'])
+        self.defaults = tuple(key.get('default') for key in TYPE['keys'])
+        self.fields = { wire : tuple((i, *FIELD_CODECS[key['type']])
+                                     for i, key in enumerate(TYPE['keys'])
+                                     if key.get('wire', 1) <= wire)
+                        for wire in range(1, WIRE_VERSION + 1) }
+
+    def values(self, kwargs):
+        """
+        Tuple with the values of the keys of the type taken from kwargs.
+        Unknown keys are ignored, so newer peers can add optional keys.
+        """
+        values = []
+        for name, key_type, optional, default in self.keys:
+            if name in kwargs:
+                value = kwargs[name]
+                assert type(value) is key_type,\
+                        f"key {name} must be of type {key_type.__name__}"
+                values.append(value)
+            elif optional:
+                values.append(default)
+            else:
+                raise ValueError(f"Required key missing: {name}")
+        return tuple(values)
+
+
+class LazyMessages():
+    """
+    Read-only sequence of encoded messages that are only decoded, by decode,
+    the first time they are accessed.
+    """
+
+    def __init__(self, entries, decode):
+        self.entries = entries
+        self.decode = decode
+        self.decoded = [None] * len(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, i):
+        i = range(len(self.entries))[i] # Negative indices and IndexError
+        message = self.decoded[i]
+        if message is None:
+            message = self.decoded[i] = self.decode(self.entries[i])
+        return message
 
+    def __iter__(self):
+        for i in range(len(self.entries)):
+            yield self[i]
+
+    def slice(self, start, stop):
+        """
+        LazyMessages with the entries from start to stop, and those of them
+        already decoded
+        """
+        lazy = LazyMessages(self.entries[start:stop], self.decode)
+        lazy.decoded = self.decoded[start:stop]
+        return lazy
 
 class MessageHistory():
+    """
+    Messages sorted by timestamp. If a capacity is given, the oldest messages
+    are evicted once it is reached.
+
+    By default the messages are kept in a local deque. With a manager they
+    live in a shared list instead, where every operation is a round trip to
+    the manager process.
+
+    A local history can also hold LazyMessages older than everything in
+    messages. They are decoded newest first, only when latest() or
+    materialize() reach them.
+    """
+
     def __init__(self, **args):
         self.manager = args.get('manager', None)
+        self.capacity = args.get('capacity', None)
+        self.older = [] # [LazyMessages, messages not yet decoded], oldest first
         messages = args.get('messages', [])
+        if type(messages) is LazyMessages and not self.manager:
+            if len(messages):
+                self.older.append([messages, len(messages)])
+            messages = []
+        messages = sorted(messages)
+        if self.capacity:
+            messages = messages[-self.capacity:]
         if self.manager:
-            self.messages = self.manager.list(messages) #TODO: sort
+            self.messages = self.manager.list(messages)
         else:
-            self.messages = messages #TODO: sort
+            self.messages = deque(messages, maxlen = self.capacity)
+        self._trim_older()
 
     def add(self, new_message):
         assert new_message.type != MESSAGE_HISTORY
-        bisect.insort(self.messages, new_message)
+        messages = self.messages
+        if self.manager:
+            bisect.insort(messages, new_message)
+            if self.capacity and len(messages) > self.capacity:
+                messages.pop(0)
+            return
+        if self.older:
+            lazy, n = self.older[-1]
+            if new_message < (messages[0] if messages else lazy[n-1]):
+                self.materialize()
+        if not messages or not new_message < messages[-1]:
+            # Messages mostly arrive in order, the deque evicts by itself
+            messages.append(new_message)
+        elif len(messages) == self.capacity:
+            if new_message < messages[0]:
+                return # Older than anything kept
+            messages.popleft()
+            messages.insert(bisect.bisect_right(messages, new_message), new_message)
+        else:
+            messages.insert(bisect.bisect_right(messages, new_message), new_message)
+        if self.older:
+            self._trim_older()
+
+    def merge(self, other):
+        """
+        Add the messages of another history. If they are all lazy and older
+        than everything here they are adopted without decoding them.
+        """
+        if not self.manager and other.older and not other.messages:
+            lazy, n = other.older[-1]
+            oldest = self._oldest()
+            if oldest is None or lazy[n-1] < oldest:
+                self.older = [list(chunk) for chunk in other.older] + self.older
+                self._trim_older()
+                return
+        for message in other.materialize():
+            self.add(message)
+        self._trim_older()
+
+    def _trim_older(self):
+        """
+        Forget the oldest lazy messages, those that don't fit in capacity
+        with messages
+        """
+        if not self.capacity or not self.older:
+            return
+        room = self.capacity - len(self.messages)
+        older = []
+        for lazy, n in reversed(self.older):
+            if room <= 0:
+                break
+            if n > room:
+                lazy, n = lazy.slice(n - room, n), room
+            older.append([lazy, n])
+            room -= n
+        older.reverse()
+        self.older = older
+
+    def _oldest(self):
+        if self.older:
+            lazy, n = self.older[0]
+            return lazy[0]
+        if self.messages:
+            return self.messages[0]
+        return None
+
+    def _decode_one(self):
+        """
+        Move the newest lazy message to messages. False if there was no room.
+        """
+        chunk = self.older[-1]
+        chunk[1] -= 1
+        message = chunk[0][chunk[1]]
+        if chunk[1] == 0:
+            self.older.pop()
+        if len(self.messages) == self.capacity:
+            self.older.clear() # Everything left is older than what is kept
+            return False
+        self.messages.appendleft(message)
+        return True
+
+    def latest(self, n):
+        """
+        The newest n messages, oldest first
+        """
+        while len(self.messages) < n and self.older:
+            if not self._decode_one():
+                break
+        start = max(len(self.messages) - n, 0)
+        return [self.messages[i] for i in range(start, len(self.messages))]
+
+    def materialize(self):
+        """
+        Decode every lazy message and return messages
+        """
+        while self.older:
+            if not self._decode_one():
+                break
+        return self.messages
+
+    def __reversed__(self):
+        """
+        Newest first. Lazy messages are decoded as they are reached, but stay
+        lazy.
+        """
+        yield from reversed(self.messages)
+        for lazy, n in reversed(self.older):
+            for i in range(n - 1, -1, -1):
+                yield lazy[i]
 
     def encode(self, _json = True):
         result = []
-        for message in self.messages:
+        for message in self.materialize():
             result.append(message.encode())
         if _json:
             return json.dumps(result)
         return result
 
     def __len__(self):
-        return len(self.messages)
+        length = len(self.messages) + sum(n for _, n in self.older)
+        if self.capacity:
+            return min(length, self.capacity)
+        return length
 
     def __str__(self):
         result = ""
-        for message in self.messages:
+        for message in self.materialize():
             result += f"{message}\n"
         return result
 
+def iter_history(json_encoded):
+    """
+    Yield the messages of a JSON encoded history as they are parsed
+    """
+    decoder = json.JSONDecoder()
+    i = SEPARATORS.match(json_encoded, json_encoded.index('[') + 1).end()
+    while json_encoded[i] != ']':
+        payload, i = decoder.raw_decode(json_encoded, i)
+        yield Message(payload = payload)
+        i = SEPARATORS.match(json_encoded, i).end()
+
+SEPARATORS = re.compile(r'[\s,]*')
+
 def decode_history(json_encoded):
-    message_list = []
-    for payload in json.loads(json_encoded):
-        message_list.append(Message(payload = payload))
-    return message_list
+    return list(iter_history(json_encoded))
+
+def unpack_messages(message):
+    """
+    List of the messages carried by a message: the contents of a batch or a
+    history, or just the message itself.
+    """
+    if message.type == MESSAGE_BATCH:
+        result = []
+        for inner in message.get('messages'):
+            result += unpack_messages(inner)
+        return result
+    elif message.type == MESSAGE_HISTORY:
+        return list(message.get('history').materialize())
+    return [message]
+
+def _is_utf8(text):
+    try:
+        text.encode('utf-8')
+        return True
+    except UnicodeEncodeError:
+        return False
+
+def to_epoch_us(timestamp):
+    # A double holds epoch microseconds of this era exactly enough to round
+    return round(timestamp.timestamp() * 1000000)
+
+def from_epoch_us(epoch_us):
+    return datetime.fromtimestamp(epoch_us / 1000000)
+
+def parse_timestamp(timestamp):
+    """
+    Timestamp of a dict payload: an ISO 8601 string (DATETIME_FORMAT) or
+    epoch microseconds.
+    """
+    if type(timestamp) is str:
+        return datetime.fromisoformat(timestamp)
+    return timestamp
+
+def encode_frame(message, wire = 0):
+    """
+    Serialize a message for the wire: the pickled dict payload when wire is 0
+    and the binary framing otherwise.
+    """
+    if wire == 0:
+        return pickle.dumps(message.encode())
+    parts = [FRAME_HEADER.pack(FRAME_MAGIC, wire, message._schema.code,
+                               message._epoch_us)]
+    values = message._values
+    for i, pack, _ in message._schema.fields[wire]:
+        parts.append(pack(values[i], wire))
+    return b''.join(parts)
+
+def encode_batch(frames, wire = WIRE_VERSION):
+    """
+    MESSAGE_BATCH frame wrapping already encoded binary frames, so they
+    don't have to be decoded and encoded again.
+    """
+    parts = [FRAME_HEADER.pack(FRAME_MAGIC, wire, MESSAGE_BATCH['code'],
+                               to_epoch_us(datetime.now())),
+             LENGTH.pack(len(frames))]
+    for frame in frames:
+        parts.append(_pack_bytes(frame))
+    return b''.join(parts)
+
+def compress_frame(frame, wire = WIRE_VERSION):
+    """
+    COMPRESSED frame wrapping a binary frame compressed with zlib. Frames
+    smaller than COMPRESS_MIN_BYTES, or that don't get smaller, are returned
+    as they are.
+    """
+    if len(frame) < COMPRESS_MIN_BYTES:
+        return frame
+    compressed = zlib.compress(frame, COMPRESS_LEVEL)
+    if len(compressed) + FRAME_HEADER.size >= len(frame):
+        return frame
+    return FRAME_HEADER.pack(FRAME_MAGIC, wire, COMPRESSED['code'],
+                             to_epoch_us(datetime.now())) + compressed
+
+def _decompress(data):
+    decompressor = zlib.decompressobj()
+    try:
+        frame = decompressor.decompress(data, MAX_FRAME_BYTES)
+    except zlib.error as e:
+        raise ValueError(f"Corrupt compressed frame: {e}")
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Compressed frame larger than {MAX_FRAME_BYTES} bytes")
+    return frame
+
+def nodelay(conn):
+    """
+    Disable Nagle's algorithm on the socket of a connection. Frames are
+    small and written whole, waiting to coalesce them only adds latency (about
+    40 ms to the CONNECT that follows the authentication).
+    """
+    try:
+        sock = socket.socket(fileno=conn.fileno())
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        finally:
+            sock.detach()
+    except OSError:
+        pass
+
+def decode_frame(frame):
+    """
+    Inverse of encode_frame, whichever the format of the frame is.
+    """
+    if frame[:1] != FRAME_MAGIC:
+        try:
+            return Message(payload = pickle.loads(frame))
+        except (AssertionError, ValueError):
+            raise
+        except Exception as e: # Unpickling fails in many ways
+            raise ValueError(f"Malformed frame: {e!r}")
+    if len(frame) < FRAME_HEADER.size:
+        raise ValueError(f"Truncated frame: {len(frame)} bytes")
+    _, version, code, epoch_us = FRAME_HEADER.unpack_from(frame)
+    if not 0 < version <= WIRE_VERSION:
+        raise ValueError(f"Unsupported wire version: {version}")
+    if code == COMPRESSED['code']:
+        return decode_frame(_decompress(frame[FRAME_HEADER.size:]))
+    schema = schema_of(code)
+    offset = FRAME_HEADER.size
+    values = list(schema.defaults)
+    try:
+        for i, _, unpack in schema.fields[version]:
+            if unpack is _unpack_str: # Most fields, inlined
+                n, = LENGTH.unpack_from(frame, offset)
+                offset += LENGTH.size
+                if offset + n > len(frame):
+                    raise ValueError(f"Truncated field: {n} bytes at {offset}"
+                                     f" of {len(frame)}")
+                values[i] = frame[offset:offset+n].decode()
+                offset += n
+            else:
+                values[i], offset = unpack(frame, offset)
+    except struct.error as e:
+        raise ValueError(f"Malformed {schema.type['name']} frame: {e}")
+    # The codecs only produce values of the right types, no need to check them
+    message = Message.__new__(Message)
+    message._schema = schema
+    message._epoch_us = epoch_us
+    message._timestamp = message._hash = None
+    message._values = tuple(values)
+    return message
+
+LENGTH = struct.Struct('!I')
+BOOL = struct.Struct('?')
+INT = struct.Struct('!q')
+
+def _pack_bytes(data):
+    return LENGTH.pack(len(data)) + data
+
+def _unpack_bytes(frame, offset):
+    n, = LENGTH.unpack_from(frame, offset)
+    offset += LENGTH.size
+    if offset + n > len(frame):
+        raise ValueError(f"Truncated field: {n} bytes at {offset} of {len(frame)}")
+    return frame[offset:offset+n], offset+n
+
+def _unpack_str(frame, offset):
+    data, offset = _unpack_bytes(frame, offset)
+    return str(data, 'utf-8'), offset
+
+def _pack_messages(messages, wire):
+    parts = [LENGTH.pack(len(messages))]
+    for message in messages:
+        parts.append(_pack_bytes(encode_frame(message, wire)))
+    return b''.join(parts)
+
+def _unpack_messages(frame, offset):
+    n, = LENGTH.unpack_from(frame, offset)
+    offset += LENGTH.size
+    messages = []
+    for _ in range(n):
+        data, offset = _unpack_bytes(frame, offset)
+        messages.append(decode_frame(data))
+    return messages, offset
+
+def _unpack_history(frame, offset):
+    n, = LENGTH.unpack_from(frame, offset)
+    offset += LENGTH.size
+    frames = []
+    for _ in range(n):
+        data, offset = _unpack_bytes(frame, offset)
+        frames.append(data)
+    return MessageHistory(messages = LazyMessages(frames, decode_frame)), offset
+
+def _struct_codec(fmt):
+    def pack(value, wire):
+        return fmt.pack(value)
+    def unpack(frame, offset):
+        return fmt.unpack_from(frame, offset)[0], offset + fmt.size
+    return pack, unpack
+
+FIELD_CODECS = {
+        str            : (lambda value, wire: _pack_bytes(value.encode('utf-8')),
+                          _unpack_str),
+        bool           : _struct_codec(BOOL),
+        int            : _struct_codec(INT),
+        list           : (_pack_messages, _unpack_messages),
+        MessageHistory : (lambda history, wire: _pack_messages(history.materialize(), wire),
+                          _unpack_history),
+        }
 
 
 ERROR = {
@@ -156,7 +637,15 @@ CLOSE = {
 CONNECT = {
         'name' : 'Connect',
         'code' : 1,
-        'keys' : [ { 'name': 'username', 'type': str, 'optional': False } ]
+        'keys' : [
+            { 'name': 'username', 'type': str, 'optional': False },
+            { 'name': 'wire', 'type': int, 'optional': True, 'default': 0 },
+            # Epoch microseconds of the newest message the client has, 0 for all
+            { 'name': 'since', 'type': int, 'optional': True, 'default': 0 },
+            # Compression methods the client can decode, ZLIB or 0 for none
+            { 'name': 'compress', 'type': int, 'optional': True, 'default': 0,
+              'wire': 4 },
+            ]
         }
 
 ACK = {
@@ -171,6 +660,8 @@ MESSAGE = {
         'keys' : [
             { 'name': 'message', 'type': str, 'optional': False },
             { 'name': 'username', 'type': str, 'optional': False },
+            { 'name': 'channel', 'type': str, 'optional': True,
+              'default': DEFAULT_CHANNEL, 'wire': 3 },
             ]
         }
 
@@ -180,10 +671,91 @@ MESSAGE_HISTORY = {
         'keys' : [ { 'name': 'history', 'type': MessageHistory, 'optional': False }, ]
         }
 
-MESSAGE_TYPES = [ERROR, CLOSE, CONNECT, ACK, MESSAGE, MESSAGE_HISTORY]
+SERVER_INFO = {
+        'name' : 'ServerInfo',
+        'code' : 5,
+        'keys' : [
+            { 'name': 'key', 'type': str, 'optional': False },
+            { 'name': 'value', 'type': str, 'optional': False },
+            ]
+        }
+
+MESSAGE_BATCH = {
+        'name' : 'MessageBatch',
+        'code' : 6,
+        'keys' : [ { 'name': 'messages', 'type': list, 'optional': False }, ]
+        }
+
+# Sent empty to ask for the metrics of the server, which answers with them
+STATS = {
+        'name' : 'Stats',
+        'code' : 7,
+        'keys' : [ { 'name': 'stats', 'type': str, 'optional': True, 'default': '' }, ]
+        }
+
+# Subscribe to a channel. The server answers with its history since since.
+JOIN = {
+        'name' : 'Join',
+        'code' : 8,
+        'keys' : [
+            { 'name': 'channel', 'type': str, 'optional': False },
+            { 'name': 'since', 'type': int, 'optional': True, 'default': 0 },
+            ]
+        }
+
+LEAVE = {
+        'name' : 'Leave',
+        'code' : 9,
+        'keys' : [ { 'name': 'channel', 'type': str, 'optional': False }, ]
+        }
+
+# Header of a frame compressed by compress_frame, which follows it. Frames
+# are decoded to the message inside, there are no messages of this type.
+COMPRESSED = {
+        'name' : 'Compressed',
+        'code' : 10,
+        'keys' : []
+        }
+
+# Full text search of the stored chat messages. Empty filters match
+# everything, since and until are epoch microseconds. Answered with a
+# SEARCH_RESULT with the page of results, best ranked first.
+SEARCH = {
+        'name' : 'Search',
+        'code' : 11,
+        'keys' : [
+            { 'name': 'query', 'type': str, 'optional': False },
+            { 'name': 'username', 'type': str, 'optional': True, 'default': '' },
+            { 'name': 'channel', 'type': str, 'optional': True, 'default': '' },
+            { 'name': 'since', 'type': int, 'optional': True, 'default': 0 },
+            { 'name': 'until', 'type': int, 'optional': True, 'default': 0 },
+            { 'name': 'page', 'type': int, 'optional': True, 'default': 0 },
+            ]
+        }
+
+SEARCH_RESULT = {
+        'name' : 'SearchResult',
+        'code' : 12,
+        'keys' : [
+            { 'name': 'query', 'type': str, 'optional': False },
+            { 'name': 'page', 'type': int, 'optional': True, 'default': 0 },
+            { 'name': 'more', 'type': bool, 'optional': True, 'default': False },
+            { 'name': 'results', 'type': list, 'optional': False },
+            ]
+        }
+
+MESSAGE_TYPES = [ERROR, CLOSE, CONNECT, ACK, MESSAGE, MESSAGE_HISTORY, SERVER_INFO,
+                 MESSAGE_BATCH, STATS, JOIN, LEAVE, COMPRESSED, SEARCH, SEARCH_RESULT]
+
+TYPES_BY_CODE = { TYPE['code'] : TYPE for TYPE in MESSAGE_TYPES }
+SCHEMAS = { TYPE['code'] : Schema(TYPE) for TYPE in MESSAGE_TYPES }
 
 def code_to_type(code):
-    for TYPE in MESSAGE_TYPES:
-        if TYPE['code'] == code:
-            return TYPE
+    return TYPES_BY_CODE.get(code)
+
+def schema_of(code):
+    try:
+        return SCHEMAS[code]
+    except KeyError:
+        raise ValueError(f"Unknown message type code: {code}")
 
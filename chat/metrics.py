@@ -0,0 +1,137 @@
+from collections import defaultdict
+from threading import Lock
+from time import monotonic
+import math, resource
+
+SAMPLE_EVERY = 100 # Events printed out of each kind in sampled mode: 1 in N
+BUCKETS_PER_OCTAVE = 4 # Histogram resolution: about 19% per bucket
+
+class Histogram():
+    """
+    Distribution of durations in logarithmic buckets of microseconds, so
+    that recording is O(1) and memory doesn't grow with the observations.
+    Percentiles are reported as the upper bound of their bucket.
+    """
+
+    def __init__(self, per_octave = BUCKETS_PER_OCTAVE):
+        self.per_octave = per_octave
+        self.buckets = defaultdict(int)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        us = seconds * 1e6
+        self.buckets[int(math.log2(us) * self.per_octave) if us > 1 else 0] += 1
+        self.n += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def merge(self, other):
+        assert self.per_octave == other.per_octave
+        for bucket, n in other.buckets.items():
+            self.buckets[bucket] += n
+        self.n += other.n
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= p * self.n:
+                return min(2 ** ((bucket + 1) / self.per_octave), self.max)
+        return 0.0
+
+    def summary(self):
+        """
+        count and, in microseconds, mean, p50, p90, p99, p999 and max
+        """
+        if not self.n:
+            return { "count" : 0 }
+        return { "count" : self.n,
+                 "mean"  : round(self.total / self.n, 1),
+                 "p50"   : round(self.percentile(0.5), 1),
+                 "p90"   : round(self.percentile(0.9), 1),
+                 "p99"   : round(self.percentile(0.99), 1),
+                 "p999"  : round(self.percentile(0.999), 1),
+                 "max"   : round(self.max, 1) }
+
+class Metrics():
+    """
+    Counters, latency histograms and gauges of the server. They can be
+    updated from any thread. snapshot() summarizes them, with the rate of
+    every counter since the previous snapshot.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.gauges = {} # name: function returning the current value
+        self.started = self.last_snapshot = monotonic()
+        self.last_counters = {}
+        self.gauge("max_rss_kb",
+                   lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.histograms[name].record(seconds)
+
+    def observe_many(self, name, durations):
+        with self.lock:
+            histogram = self.histograms[name]
+            for seconds in durations:
+                histogram.record(seconds)
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def snapshot(self):
+        now = monotonic()
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = { name : histogram.summary()
+                           for name, histogram in self.histograms.items() }
+            elapsed = now - self.last_snapshot
+            rates = { name : round((n - self.last_counters.get(name, 0)) / elapsed, 1)
+                      for name, n in counters.items() }
+            self.last_counters = counters
+            self.last_snapshot = now
+        return { "uptime"     : round(now - self.started, 3),
+                 "counters"   : counters,
+                 "rates"      : rates,
+                 "histograms" : histograms,
+                 "gauges"     : { name : function()
+                                  for name, function in self.gauges.items() } }
+
+class ConsoleLog():
+    """
+    Decides which of the frequent events (a message broadcast, a history
+    sent) get printed: all of them, one in SAMPLE_EVERY of each kind, or
+    none. Printing every message costs more than broadcasting it.
+    """
+
+    MODES = ["all", "sampled", "off"]
+
+    def __init__(self, mode = "all", every = SAMPLE_EVERY):
+        assert mode in ConsoleLog.MODES, f"Unknown log mode: {mode}"
+        self.mode = mode
+        self.every = every
+        self.seen = defaultdict(int)
+
+    def sampled(self, kind):
+        """
+        Whether this event of the given kind should be printed
+        """
+        if self.mode == "all":
+            return True
+        elif self.mode == "off":
+            return False
+        self.seen[kind] += 1
+        return (self.seen[kind] - 1) % self.every == 0
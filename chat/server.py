@@ -1,28 +1,181 @@
 #!/usr/bin/env python3
 from multiprocessing.connection import Listener
-from multiprocessing import Process, Manager, AuthenticationError
-import sqlite3, json
-from time import sleep
+from multiprocessing import Process, Queue, AuthenticationError
+from threading import Thread, Lock, Event, Timer
+from queue import Queue as LocalQueue, Full, Empty
+from asyncio import QueueFull, QueueEmpty
+from itertools import count
+from collections import deque
+import sqlite3, json, socket, bisect, zlib
+from time import sleep, perf_counter
 from datetime import datetime
 
 from messages import *
+from metrics import Metrics, ConsoleLog
+
+OUTBOX_SIZE = 256 # Frames buffered per client before it's considered stalled
+OUTBOX_MIN = 2 # An evicted client needs room for its ERROR and the close
+OUTBOX_MAX_BYTES = 4 * 1024 * 1024 # Backlog a client can have with coalesce
+EVICT_GRACE = 1.0 # Seconds an evicted client has to read its ERROR
+SLOW_POLICIES = ["disconnect", "drop_oldest", "coalesce"]
+BATCH_WINDOW = 0.002 # Seconds a writer waits for more frames to coalesce
+BATCH_MAX_BYTES = 64 * 1024
+HISTORY_SIZE = 100 # Messages loaded from the database on start
+HISTORY_PAGE = 500 # Messages per MESSAGE_HISTORY frame
+FLUSH_SIZE = 256 # Buffered messages that trigger a database flush
+FLUSH_INTERVAL = 0.5 # Maximum seconds a message stays buffered
+SCHEMA_VERSION = 3 # Stored in PRAGMA user_version
+SEARCH_PAGE = 20 # Results per SEARCH_RESULT
+SEARCH_QUEUE = 64 # Searches waiting before new ones are turned down
+SEARCH_WINDOW = 10000 # Newest matches that are ranked, the rest are ignored
+
+class ClientRegistry():
+    """
+    In-process registry of the connected clients.
+
+    Membership checks are plain dict lookups and broadcasts iterate over an
+    immutable snapshot that is only rebuilt when somebody joins or leaves, so
+    the hot path takes no lock and copies nothing. Mutations must be
+    serialized by the caller.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._snapshot = ()
+
+    def _refresh(self):
+        self._snapshot = tuple(self._clients.items())
+
+    def __setitem__(self, username, data):
+        self._clients[username] = data
+        self._refresh()
+
+    def __getitem__(self, username):
+        return self._clients[username]
+
+    def __contains__(self, username):
+        return username in self._clients
+
+    def __iter__(self):
+        return (username for username, _ in self._snapshot)
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    def get(self, username, default=None):
+        return self._clients.get(username, default)
+
+    def pop(self, username, default=None):
+        data = self._clients.pop(username, default)
+        self._refresh()
+        return data
+
+    def items(self):
+        return self._snapshot
+
+class ChannelIndex():
+    """
+    Subscribers of every channel, each channel with its own ClientRegistry,
+    so a broadcast to a channel only iterates the snapshot of its
+    subscribers. A channel is dropped when its last subscriber leaves.
+    """
+
+    def __init__(self):
+        self._channels = {}
+
+    def subscribe(self, channel, username, data):
+        if channel not in self._channels:
+            self._channels[channel] = ClientRegistry()
+        self._channels[channel][username] = data
+
+    def unsubscribe(self, channel, username):
+        """
+        Returns False if the channel is left without subscribers
+        """
+        registry = self._channels.get(channel)
+        if registry is not None:
+            registry.pop(username)
+            if len(registry):
+                return True
+            del self._channels[channel]
+        return False
+
+    def subscribers(self, channel):
+        registry = self._channels.get(channel)
+        return registry.items() if registry is not None else ()
+
+    def __len__(self):
+        return len(self._channels)
 
 class ChatServer():
-    def __init__(self, ip="127.0.0.1", port=6000, authkey=b"secret password"):
+    """
+    Chat server with one receiving process per client.
+
+    The receiving processes only read the raw frames their client sends and
+    forward them, undecoded, to the main process through a single queue.
+    There a dispatcher thread decodes and handles them. The main process owns
+    the client registry, the history and the connections used for writing.
+
+    Chat messages are only sent to the subscribers of their channel. Every
+    client is subscribed to DEFAULT_CHANNEL and can JOIN and LEAVE others.
+    The history of a channel is loaded from the database when it is first
+    needed and forgotten when nobody is subscribed to it. The frames of a
+    whole history are cached in self.snapshots until a message is added to
+    it, so a burst of connections encodes and compresses it only once.
+    Clients that accept it get history and batch frames compressed.
+
+    SEARCH messages are answered by a searcher thread, on its own database
+    connection, so they don't hold up the broadcasts.
+
+    Counters and latencies are kept in self.metrics and sent to any client
+    that asks with a STATS message. log is the ConsoleLog mode of the
+    per-message output: all, sampled or off.
+
+    Each client has an outbox of outbox_size frames. When a client doesn't
+    read fast enough to keep it from filling up, policy decides what
+    happens to it:
+        disconnect      the backlog is dropped and the client evicted, with
+                        a critical ERROR
+        drop_oldest     the oldest frame waiting is dropped
+        coalesce        the backlog is merged into a single MESSAGE_BATCH,
+                        up to OUTBOX_MAX_BYTES, and then disconnect
+    The frames lost are counted as dropped, the clients disconnected as
+    evicted.
+    """
+
+    def __init__(self, ip="127.0.0.1", port=6000, authkey=b"secret password",
+            log="all", outbox_size=OUTBOX_SIZE, policy="disconnect"):
+        assert policy in SLOW_POLICIES, f"Unknown slow client policy: {policy}"
+        assert outbox_size >= OUTBOX_MIN, f"The outbox must hold {OUTBOX_MIN} frames"
         self.addr = (ip, int(port))
         self.authkey = authkey
-        self.manager = Manager()
-        self.clients = self.manager.dict()
+        self.outbox_size = outbox_size
+        self.policy = policy
         self.listener = None
-        self.db = ServerData()
-        self.history = MessageHistory(manager = self.manager,
-                messages = self.db.select_messages(n=100))
+        self.metrics = Metrics()
+        self.console = ConsoleLog(log)
+        self.db = ServerData(metrics = self.metrics)
+        self.clients = ClientRegistry()
+        self.channels = ChannelIndex()
+        self.histories = {} # channel: MessageHistory
+        self.snapshots = {} # channel: {(wire, compress): history frames}
+        self.channel_history(DEFAULT_CHANNEL)
+        self.sessions = count(1)
+        self.lock = Lock()
+        self.inbox = None
+        self.searches = LocalQueue(SEARCH_QUEUE)
+        searcher = Thread(target=self._search_loop, name="searcher")
+        searcher.daemon = True
+        searcher.start()
+        self.metrics.gauge("clients", lambda: len(self.clients))
+        self.metrics.gauge("channels", lambda: len(self.channels))
+        self.metrics.gauge("outbox_depth_max", lambda: max(
+            (data["queue"].qsize() for _, data in self.clients.items()), default=0))
+        self.metrics.gauge("inbox_depth",
+                           lambda: self.inbox.qsize() if self.inbox else 0)
 
     def usernames(self):
-        users = []
-        for username in self.clients:
-            users.append(username)
-        return users
+        return list(self.clients)
 
     def start(self):
         try:
@@ -32,6 +185,10 @@ class ChatServer():
         else:
             ip, port = self.addr
             print(f"Server listening on {ip}:{port}")
+            self.inbox = Queue()
+            dispatcher = Thread(target=self._dispatch_loop, name="dispatcher")
+            dispatcher.daemon = True
+            dispatcher.start()
             while True:
                 self._listen()
             self.listener.close()
@@ -43,77 +200,352 @@ class ChatServer():
         except AuthenticationError as e:
             print("Authentication error")
             return
+        nodelay(conn)
         username = None
+        start = perf_counter()
         try:
-            payload = conn.recv()
-            assert payload["type_code"] == CONNECT['code'],\
+            message = decode_frame(conn.recv_bytes())
+            assert message.type == CONNECT,\
                 "First message must be of type CONNECT"
-            username = self.connect(payload, client_ip, conn)
+            with self.lock:
+                username = self.connect(message, client_ip, conn)
+            self.metrics.observe("handshake", perf_counter() - start)
         except EOFError as eof:
             print("Error receiving connection message.")
-        except AssertionError as e:
+        except (AssertionError, ValueError) as e:
             print(e)
         finally:
             if username:
-                p = Process(target=self._client_loop, args=(username,),\
+                session = self.clients[username]["session"]
+                p = Process(target=self._client_loop,
+                        args=(username, session, conn, self.inbox),
                         name=f"{username} listener")
                 p.daemon = True
                 p.start()
+            else:
+                conn.close()
 
-    def _client_loop(self, username):
-        conn = self.clients[username]["conn"]
-        while username in self.clients:
+    @staticmethod
+    def _client_loop(username, session, conn, inbox):
+        """
+        Runs in the receiving process of a client. A None frame tells the main
+        process that the connection is gone.
+        """
+        while True:
             try:
-                payload = conn.recv()
+                frame = conn.recv_bytes()
             except Exception as e:
                 if type(e) is EOFError:
                     print(f"Connection down :(")
                 else:
                     print(f"Error: {e}")
-                self.client_close(username)
+                inbox.put((username, session, None))
+                break
+            else:
+                inbox.put((username, session, frame))
+        conn.close()
+
+    def _dispatch_loop(self):
+        while True:
+            username, session, frame = self.inbox.get()
+            with self.lock:
+                if frame is None:
+                    self.client_close(username, session)
+                else:
+                    self._parse_payload(username, frame, session)
+
+    def _open_outbox(self, username, conn, wire, compress):
+        """
+        Create the bounded outbound queue of a client and start the writer
+        thread that drains it into the connection.
+        """
+        queue = LocalQueue(self.outbox_size)
+        backlog = deque() # History frames still to send, see join_channel
+        lock = Lock() # Closing the connection, see _abort_outbox
+        writer = Thread(target=self._write_loop,
+                args=(username, conn, queue, backlog, wire, compress, lock),
+                name=f"{username} writer")
+        writer.daemon = True
+        writer.start()
+        return { "conn" : conn, "queue" : queue, "backlog" : backlog,
+                 "lock" : lock }
+
+    def _write_loop(self, username, conn, queue, backlog, wire, compress, lock):
+        closing = False
+        while not closing:
+            item = backlog_item(backlog) if queue.empty() else None
+            items = [item or queue.get()]
+            if items[0] is None:
+                break
+            if wire >= 2:
+                sleep(BATCH_WINDOW)
+                closing = collect_frames(queue, items)
+            try:
+                conn.send_bytes(coalesce(items, wire, compress))
+            except Exception as e:
+                print(f"Error sending to {username}: {e}")
+                break
+            self._sent(items)
+        with lock:
+            shutdown(conn)
+            conn.close()
+
+    def _sent(self, items):
+        """
+        Account for (frame, enqueued) items written to a client
+        """
+        now = perf_counter()
+        self.metrics.count("writes")
+        self.metrics.observe_many("send_latency",
+                                  [now - enqueued for _, enqueued in items])
+
+    def _close_outbox(self, outbox):
+        try:
+            outbox["queue"].put_nowait(None)
+        except Full:
+            shutdown(outbox["conn"]) # Unblocks the writer
+
+    def _abort_outbox(self, outbox):
+        """
+        Unblock a writer that is still stuck sending to its client
+        """
+        with outbox["lock"]:
+            if not outbox["conn"].closed:
+                shutdown(outbox["conn"])
+
+    def _abort_later(self, outbox):
+        timer = Timer(EVICT_GRACE, self._abort_outbox, (outbox,))
+        timer.daemon = True
+        timer.start()
+
+    def _enqueue(self, username, outbox, frame):
+        item = (frame, perf_counter())
+        try:
+            outbox["queue"].put_nowait(item)
+        except (Full, QueueFull):
+            if username in self.clients:
+                self._overflow(username, outbox, item)
+
+    def _overflow(self, username, outbox, item):
+        """
+        Apply the slow client policy to a client whose outbox is full. Only
+        the writer takes from the outbox meanwhile, so there will be room
+        for whatever is put back.
+        """
+        queue = outbox["queue"]
+        wire = outbox["wire"]
+        if self.policy == "drop_oldest" or\
+                (self.policy == "coalesce" and wire < 2): # No batches
+            try:
+                queue.get_nowait()
+                self.metrics.count("dropped")
+            except (Empty, QueueEmpty):
+                pass # The writer just took it
+            queue.put_nowait(item)
+        elif self.policy == "coalesce":
+            items = take_all(queue) + [item]
+            frames = [frame for frame, _ in items]
+            if sum(map(len, frames)) <= OUTBOX_MAX_BYTES:
+                frame = encode_batch(frames, wire)
+                if outbox["compress"]:
+                    frame = compress_frame(frame, wire)
+                queue.put_nowait((frame, items[0][1]))
+                self.metrics.count("coalesced", len(items) - 1)
             else:
-                self._parse_payload(username, payload)
+                self._evict(username, outbox, len(items))
+        else:
+            self._evict(username, outbox, 1)
 
-    def _parse_payload(self, username, payload):
-        message = Message(payload = payload)
+    def _evict(self, username, outbox, dropped):
+        """
+        Disconnect a slow client. Its backlog is replaced by a critical
+        ERROR, which it gets if it reads within EVICT_GRACE seconds.
+        """
+        dropped += len(take_all(outbox["queue"]))
+        self.metrics.count("dropped", dropped)
+        self.metrics.count("evicted")
+        print(f"{username} is not reading, disconnecting")
+        error = Message(type=ERROR, critical=True,
+                        message="Disconnected for not reading messages fast enough")
+        frame = encode_frame(error, outbox["wire"])
+        outbox["queue"].put_nowait((frame, perf_counter()))
+        self.client_close(username)
+        self._abort_later(outbox)
+
+    def _parse_payload(self, username, frame, session = None):
         try:
+            message = decode_frame(frame)
             if message.type == CLOSE:
-                self.client_close(username)
+                self.client_close(username, session)
+            elif not self._is_current(username, session):
+                pass
             elif message.type == MESSAGE:
-                self.broadcast_message(message)
+                self.metrics.count("messages_in")
+                channel = message.get('channel')
+                if channel in self.clients[username]["channels"]:
+                    self.broadcast_message(message)
+                else:
+                    self.send_error(username, f"Join {channel} to write in it")
+            elif message.type == JOIN:
+                self.join_channel(username, message.get('channel'),
+                                  message.get('since'))
+            elif message.type == LEAVE:
+                self.leave_channel(username, message.get('channel'))
+            elif message.type == STATS:
+                self.send_stats(username)
+            elif message.type == SEARCH:
+                self.search(username, session, message)
         except Exception as e:
             print(f"Error parsing payload: {e}")
-            print(f"payload = {payload}")
+            print(f"frame = {frame}")
+
+    def _is_current(self, username, session):
+        """
+        Whether session is the live one of username. Payloads from a previous
+        connection of the same user may still arrive after a reconnection.
+        """
+        data = self.clients.get(username)
+        return data is not None and (session is None or data["session"] == session)
 
-    def connect(self, payload, client_ip, conn):
-        message = Message(payload = payload)
+    def connect(self, message, client_ip, conn):
         assert message.type == CONNECT, 'message must be of type CONNECT'
         username = message.get('username')
+        wire = min(message.get('wire'), WIRE_VERSION)
+        since = message.get('since')
+        compress = bool(message.get('compress') & ZLIB) and wire >= 4
         if username not in self.clients:
-            self.clients[username] = { "conn" : conn, "ip" : client_ip }
+            outbox = self._open_outbox(username, conn, wire, compress)
+            data = { **outbox, "ip" : client_ip, "session" : next(self.sessions),
+                     "wire" : wire, "compress" : compress, "channels" : set() }
+            self.clients[username] = data
             message = Message(type=SERVER_INFO, key = "join", value=username) 
             self.broadcast_message(message, [username])
-            response = Message(type=MESSAGE_HISTORY, history = self.history, max_size = 0)
-            conn.send(response.encode())
-            print(f"[SEND DATA] Sending message history to {username}")
+            self.join_channel(username, DEFAULT_CHANNEL, since)
             return username
         else:
             message = Message(type=ERROR,
                               message=f"{username} is already connected!",
                               critical = True)
             print(message)
-            conn.send(message.encode())
+            conn.send_bytes(encode_frame(message, wire))
             conn.close()
             return False
 
-    def client_close(self, username):
-        if username in self.clients:
-            conn = self.clients[username]["conn"]
-            conn.close()
+    def join_channel(self, username, channel, since = 0):
+        """
+        Subscribe a client to a channel and send it the history of the
+        channel newer than since
+        """
+        data = self.clients[username]
+        if channel not in data["channels"]:
+            data["channels"].add(channel)
+            self.channels.subscribe(channel, username, data)
+        if since:
+            # However long, the history is sent as the client reads it. The
+            # writer takes the next page whenever its outbox is empty.
+            frames = page_frames(self.history_pages(since, channel),
+                                 data["wire"], data["compress"])
+            first = next(frames)
+            data["backlog"].append(frames)
+            self._enqueue(username, data, first)
+            if self.console.sampled("history"):
+                print(f"[SEND DATA] Sending the history of {channel} since {since} to {username}")
+            return
+        messages = self.channel_history(channel)
+        for frame in self.history_snapshot(channel, data["wire"], data["compress"]):
+            self._enqueue(username, data, frame)
+        if self.console.sampled("history"):
+            print(f"[SEND DATA] Sending {len(messages)} messages of history to {username}")
+
+    def leave_channel(self, username, channel):
+        data = self.clients[username]
+        if channel in data["channels"]:
+            data["channels"].remove(channel)
+            if not self.channels.unsubscribe(channel, username)\
+                    and channel != DEFAULT_CHANNEL:
+                self.forget_history(channel)
+
+    def forget_history(self, channel):
+        """
+        Called once nobody is subscribed to a channel, its history is
+        loaded from the database again if someone joins it
+        """
+        self.histories.pop(channel, None)
+        self.snapshots.pop(channel, None)
+
+    def remember(self, message):
+        """
+        Add a chat message to the history of its channel
+        """
+        channel = message.get('channel')
+        self.channel_history(channel).add(message)
+        self.snapshots.pop(channel, None)
+
+    def history_snapshot(self, channel, wire, compress):
+        """
+        Frames with the whole history of a channel, built once until it
+        changes
+        """
+        snapshots = self.snapshots.setdefault(channel, {})
+        if (wire, compress) not in snapshots:
+            messages = list(self.channel_history(channel).messages)
+            snapshots[(wire, compress)] = history_frames(messages, wire, compress)
+            self.metrics.count("history_snapshots")
+        return snapshots[(wire, compress)]
+
+    def channel_history(self, channel):
+        history = self.histories.get(channel)
+        if history is None:
+            history = MessageHistory(capacity = HISTORY_CAPACITY,
+                    messages = self.db.select_messages(channel = channel,
+                                                       n = HISTORY_SIZE, last = True))
+            self.histories[channel] = history
+        return history
+
+    def history_pages(self, since, channel = DEFAULT_CHANNEL):
+        """
+        Generator of the messages of a channel newer than since (epoch
+        microseconds), in pages of up to HISTORY_PAGE that go newest first.
+        The in-memory history is taken on the first next(), the older
+        messages are read from the database a page at a time after it.
+        """
+        messages = list(self.channel_history(channel).messages)
+        i = bisect.bisect_right(messages, since, key=lambda m: m.epoch_us)
+        for end in range(len(messages), i, -HISTORY_PAGE):
+            yield messages[max(end - HISTORY_PAGE, i):end]
+        if i > 0:
+            return # Everything the client is missing was in memory
+        before = None
+        seen = set()
+        if messages:
+            # The messages stored with the same timestamp as the oldest one
+            # in memory may or may not be in memory too
+            oldest = messages[0].epoch_us
+            before = (oldest, 2**63 - 1)
+            seen = { (m.get('username'), m.get('message'))
+                     for m in messages if m.epoch_us == oldest }
+        since = from_epoch_us(since)
+        while True:
+            rows = self.db.select_rows(from_timestamp = since, channel = channel,
+                                       before = before, last = True,
+                                       n = HISTORY_PAGE)
+            if not rows:
+                return
+            page = [row_message(row) for row in rows
+                    if not (before and row[4] == before[0] and row[2:4] in seen)]
+            if page:
+                yield page
+            before = (rows[0][4], rows[0][0])
+
+    def client_close(self, username, session = None):
+        if self._is_current(username, session):
+            for channel in list(self.clients[username]["channels"]):
+                self.leave_channel(username, channel)
+            data = self.clients.pop(username)
+            self._close_outbox(data)
             message = Message(type = SERVER_INFO, key="leave", value = username)
             self.broadcast_message(message)
-            del self.clients[username]
-        else:
+        elif session is None:
             print(f"{username} is not in current")
 
     def close_all(self):
@@ -122,83 +554,657 @@ class ChatServer():
             self.client_close(username)
 
     def stop(self):
-        self.close_all()
+        with self.lock:
+            self.close_all()
+        self.db.close()
+
+    def search(self, username, session, message):
+        """
+        Queue a search for the searcher thread
+        """
+        try:
+            self.searches.put_nowait((username, session, message))
+        except Full:
+            self.send_error(username, "Too many searches, try again later")
+
+    def _search_loop(self):
+        while True:
+            username, session, message = self.searches.get()
+            start = perf_counter()
+            try:
+                results, more = self.db.search(message.get('query'),
+                        username = message.get('username'),
+                        channel = message.get('channel'),
+                        since = message.get('since'),
+                        until = message.get('until'),
+                        page = message.get('page'))
+                response = Message(type=SEARCH_RESULT, query=message.get('query'),
+                                   page=message.get('page'), more=more,
+                                   results=results)
+            except ValueError as e:
+                response = Message(type=ERROR, message=str(e))
+            self.metrics.observe("search", perf_counter() - start)
+            self._call_soon(self._send_search_result, username, session, response)
+
+    def _call_soon(self, function, *args):
+        """
+        Run function, from another thread, where it can use the clients
+        """
+        with self.lock:
+            function(*args)
+
+    def _send_search_result(self, username, session, response):
+        if self._is_current(username, session):
+            data = self.clients[username]
+            frame = encode_frame(response, data["wire"])
+            if data["compress"]:
+                frame = compress_frame(frame, data["wire"])
+            self._enqueue(username, data, frame)
+
+    def send_error(self, username, text):
+        data = self.clients[username]
+        message = Message(type=ERROR, message=text)
+        self._enqueue(username, data, encode_frame(message, data["wire"]))
+
+    def send_stats(self, username):
+        data = self.clients[username]
+        message = Message(type=STATS, stats=json.dumps(self.metrics.snapshot()))
+        self._enqueue(username, data, encode_frame(message, data["wire"]))
 
     def broadcast_message(self, message, excluded_users = []):
-        excluded_users += [message.get('username')]
+        """
+        Store a chat message and send it to the clients that should get it.
+        Returns the frames it was encoded to, by wire version.
+        """
         if message.type == MESSAGE:
-            self.history.add(message)
+            self.remember(message)
             self.db.insert_message(message)
-        for username, data in self.clients.items():
+        return self.deliver(message, excluded_users)
+
+    def deliver(self, message, excluded_users = [], frames = None):
+        """
+        Send a message to the connected subscribers of its channel, or to
+        every client if it is not a chat message. frames may already hold
+        the message encoded for some wire versions.
+        """
+        start = perf_counter()
+        excluded_users = set(excluded_users)
+        if message.has('username'):
+            excluded_users.add(message.get('username'))
+        if message.type == MESSAGE:
+            subscribers = self.channels.subscribers(message.get('channel'))
+        else:
+            subscribers = self.clients.items()
+        # Encoded once per wire version, shared by every recipient
+        frames = frames if frames is not None else {}
+        recipients = 0
+        for username, data in subscribers:
             if not username in excluded_users:
-                data["conn"].send(message.encode())
-        print(f"[BROADCAST]\n{message}")
+                wire = data["wire"]
+                if wire not in frames:
+                    frames[wire] = encode_frame(message, wire)
+                self._enqueue(username, data, frames[wire])
+                recipients += 1
+        self.metrics.count("messages_out", recipients)
+        self.metrics.observe("fan_out", perf_counter() - start)
+        if self.console.sampled("broadcast"):
+            print(f"[BROADCAST]\n{message}")
+        return frames
+
+def take_all(queue):
+    """
+    Remove every item waiting in a queue.Queue or an asyncio.Queue
+    """
+    items = []
+    try:
+        while True:
+            items.append(queue.get_nowait())
+    except (Empty, QueueEmpty):
+        return items
+
+def collect_frames(queue, items):
+    """
+    Move the (frame, enqueued) items waiting in queue to items, up to
+    BATCH_MAX_BYTES of frames. Returns True if the close sentinel was found.
+    """
+    size = sum(len(frame) for frame, _ in items)
+    while size < BATCH_MAX_BYTES:
+        try:
+            item = queue.get_nowait()
+        except (Empty, QueueEmpty):
+            break # Also taken by _overflow
+        if item is None:
+            return True
+        items.append(item)
+        size += len(item[0])
+    return False
+
+def coalesce(items, wire, compress = False):
+    if len(items) == 1:
+        return items[0][0]
+    frame = encode_batch([frame for frame, _ in items], wire)
+    return compress_frame(frame, wire) if compress else frame
+
+def history_frames(messages, wire, compress = False):
+    """
+    MESSAGE_HISTORY frames with the messages, in pages that go newest first
+    so clients can draw before the rest arrives. Older clients only expect a
+    single frame.
+    """
+    page_size = HISTORY_PAGE if wire >= 2 else max(len(messages), 1)
+    frames = []
+    for end in range(len(messages), 0, -page_size) or [0]:
+        page = MessageHistory(messages = messages[max(end - page_size, 0):end])
+        frame = encode_frame(Message(type=MESSAGE_HISTORY, history = page), wire)
+        frames.append(compress_frame(frame, wire) if compress else frame)
+    return frames
+
+def page_frames(pages, wire, compress = False):
+    """
+    Generator of the MESSAGE_HISTORY frames of pages of messages, encoded as
+    they are taken. Older clients only expect a single frame, with every
+    page, and an empty history is still sent as an empty page.
+    """
+    if wire < 2:
+        yield from history_frames([m for page in pages for m in page], wire,
+                                  compress)
+        return
+    empty = True
+    for page in pages:
+        empty = False
+        frame = encode_frame(Message(type=MESSAGE_HISTORY,
+                history = MessageHistory(messages = page)), wire)
+        yield compress_frame(frame, wire) if compress else frame
+    if empty:
+        yield from history_frames([], wire, compress)
+
+def backlog_item(backlog):
+    """
+    (frame, enqueued) item with the next frame of the histories a client is
+    being sent, None once they are all sent
+    """
+    while backlog:
+        frame = next(backlog[0], None)
+        if frame is not None:
+            return (frame, perf_counter())
+        backlog.popleft()
+    return None
+
+def shutdown(conn):
+    """
+    Shut down the socket of a connection. Unlike close() this also takes
+    effect on the copies of the descriptor held by other processes.
+    """
+    try:
+        sock = socket.socket(fileno=conn.fileno())
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        finally:
+            sock.detach()
+    except OSError:
+        pass
+
+MESSAGE_COLUMNS = "id, type_code, username, body, timestamp, hash, channel"
+INSERT_MESSAGE = """INSERT INTO messages(type_code, username, body, timestamp, hash,
+        channel) VALUES(?,?,?,?,?,?)"""
+
+CREATE_MESSAGES = [
+        """CREATE TABLE IF NOT EXISTS messages (
+                id integer PRIMARY KEY,
+                type_code integer NOT NULL,
+                username text NOT NULL,
+                body text NOT NULL,
+                timestamp integer NOT NULL,
+                hash integer NOT NULL,
+                channel text NOT NULL
+                );""",
+        """CREATE INDEX IF NOT EXISTS messages_timestamp
+                ON messages(timestamp, id);""",
+        """CREATE INDEX IF NOT EXISTS messages_username
+                ON messages(username, timestamp, id);""",
+        """CREATE INDEX IF NOT EXISTS messages_channel
+                ON messages(channel, timestamp, id);""",
+        ]
+
+def message_row(message):
+    """
+    Values of a chat message for INSERT_MESSAGE. timestamp is stored in epoch
+    microseconds and hash is a crc32 of the rest, the same in every process.
+    """
+    row = (message.type['code'], message.get('username'),
+           message.get('message'), message.epoch_us, message.get('channel'))
+    digest = zlib.crc32(repr(row).encode())
+    return row[:4] + (digest, row[4])
+
+def is_busy(error):
+    """
+    Whether an error storing messages is worth retrying: another connection
+    holds the database
+    """
+    return type(error) is sqlite3.OperationalError and\
+            ("locked" in str(error) or "busy" in str(error))
+
+def row_message(row):
+    """
+    Message stored in a row of the messages table
+    """
+    _, type_code, username, body, timestamp, _, channel = row
+    return Message(code = type_code, username = username, message = body,
+                   channel = channel, timestamp = timestamp)
+
+SEARCH_COLUMNS = ", ".join(f"messages.{column}"
+                           for column in MESSAGE_COLUMNS.split(", "))
+
+def fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+def fts_query(text):
+    """
+    FTS5 query for the messages with every word of text in their body, or
+    with a word that starts with it if it ends with *. The words are
+    quoted, so the FTS5 query syntax can't be misused.
+    """
+    terms = []
+    for word in text.split():
+        prefix = "*" if word.endswith("*") else ""
+        word = word.rstrip("*")
+        if word:
+            terms.append(fts_phrase(word) + prefix)
+    if not terms:
+        raise ValueError("Nothing to search for")
+    return f"body : ({' '.join(terms)})"
 
 class ServerData():
-    def __init__(self, db_file = "server.db"):
+    """
+    Server database. Messages are written behind: insert_message only
+    buffers them and a flusher thread stores them with one executemany per
+    transaction, every FLUSH_INTERVAL seconds or as soon as FLUSH_SIZE are
+    waiting. A batch that can't be stored because the database is busy is
+    kept and retried, the failures are counted in db_flush_errors and the
+    backlog shown in db_pending. Messages that can't be stored at all are
+    dropped, see flush.
+
+    The messages are indexed in messages_fts, an FTS5 table updated by a
+    trigger on every insert. Usernames and channels are indexed too, so the
+    search filters are intersected in the index instead of row by row.
+    search() runs on a connection of its own, WAL lets it read while the
+    flusher writes.
+    """
+
+    def __init__(self, db_file = "server.db", flush_size = FLUSH_SIZE,
+            flush_interval = FLUSH_INTERVAL, metrics = None):
         self.conn = None
         self.db_file = db_file
+        self.metrics = metrics or Metrics()
+        self.lock = Lock() # Serializes the use of the connection
         try:
-            self.conn = sqlite3.connect(db_file) 
+            self.conn = sqlite3.connect(db_file, check_same_thread=False)
         except sqlite3.Error as e:
             print("sqlite3.Error:",e)
+        self.exec_query("PRAGMA journal_mode=WAL;")
+        self.exec_query("PRAGMA synchronous=NORMAL;")
         self.create_tables()
+        self.search_conn = None
+        if self.create_search_index():
+            self.search_conn = sqlite3.connect(db_file, check_same_thread=False)
+            self.search_conn.execute("PRAGMA query_only=ON;")
+        self.search_lock = Lock() # Serializes the use of search_conn
+        self.pending = []
+        self.pending_lock = Lock()
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.flush_needed = Event()
+        self.closed = False
+        self.metrics.gauge("db_pending", lambda: len(self.pending))
+        self.flusher = Thread(target=self._flush_loop, name="db flusher")
+        self.flusher.daemon = True
+        self.flusher.start()
 
     def exec_query(self, query, params=()):
-        try:
+        with self.lock:
+            try:
+                c = self.conn.cursor()
+                c.execute(query, params)
+                self.conn.commit()
+            except sqlite3.Error as e:
+                print("sqlite3.Error:",e)
+            rows = c.fetchall()
+        return rows
+
+    def exec_queries(self, queries, params_list=[]):
+        """
+        Run several queries in a single transaction
+        """
+        params_list = params_list or [()] * len(queries)
+        assert len(queries) == len(params_list)
+        with self.lock:
             c = self.conn.cursor()
-            c.execute(query, params)
+            for query, params in zip(queries, params_list):
+                try:
+                    c.execute(query, params)
+                except sqlite3.Error as e:
+                    print("sqlite3.Error:",e)
             self.conn.commit()
-        except sqlite3.Error as e:
-            print("sqlite3.Error:",e)
-        rows = c.fetchall()
+            rows = c.fetchall()
         return rows
 
-    def exec_queries(self, queries, params_list=[]):
-        assert len(queries) == len(params)
-        c = self.conn.cursor()
-        for i in range(len(queries)):
+    def exec_many(self, query, params_list):
+        """
+        Run a query once per params in a single transaction
+        """
+        with self.lock:
             try:
-                c.execute(query, params)
+                self.conn.executemany(query, params_list)
+                self.conn.commit()
             except sqlite3.Error as e:
+                self.conn.rollback()
                 print("sqlite3.Error:",e)
-        self.conn.commit()
-        rows = c.fetchall()
-        return rows
 
     def insert_message(self, message):
-        content = json.dumps(message.encode())
-        timestamp = message.get('timestamp').timestamp()
-        self.exec_query("INSERT INTO messages(timestamp, content) VALUES(?,?)",
-                        (timestamp, content))
+        with self.pending_lock:
+            self.pending.append(message)
+            n = len(self.pending)
+        if n >= self.flush_size:
+            self.flush_needed.set()
 
-    def select_messages(self, **kwargs):
+    def _flush_loop(self):
+        while not self.closed:
+            self.flush_needed.wait(self.flush_interval)
+            self.flush_needed.clear()
+            try:
+                if not self.flush():
+                    sleep(self.flush_interval) # Before trying again
+            except Exception as e:
+                # Whatever happens the thread must go on, or nothing is stored
+                print("Database flusher error:", repr(e))
+                self.metrics.count("db_flush_errors")
+
+    def flush(self):
+        """
+        Store the buffered messages. If the database is busy they are kept,
+        to be retried by the next flush, and False is returned. After any
+        other error they are stored one by one, and the ones that still fail
+        are dropped and counted in db_rows_dropped.
+        """
+        with self.pending_lock:
+            messages, self.pending = self.pending, []
+        if not messages:
+            return True
+        start = perf_counter()
+        try:
+            self._insert(messages)
+        except Exception as e:
+            print(f"Error storing {len(messages)} messages:", repr(e))
+            self.metrics.count("db_flush_errors")
+            if is_busy(e):
+                self._keep(messages)
+                return False
+            return self._insert_each(messages)
+        self.metrics.observe("db_flush", perf_counter() - start)
+        self.metrics.count("db_rows", len(messages))
+        return True
+
+    def _insert(self, messages):
+        rows = [message_row(m) for m in messages]
+        with self.lock:
+            try:
+                self.conn.executemany(INSERT_MESSAGE, rows)
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+
+    def _insert_each(self, messages):
+        """
+        Store messages in a transaction each, to find the ones that can't be
+        """
+        for i, message in enumerate(messages):
+            try:
+                self._insert([message])
+                self.metrics.count("db_rows")
+            except Exception as e:
+                if is_busy(e):
+                    self._keep(messages[i:])
+                    return False
+                print(f"Dropping a message that can't be stored: {e!r}")
+                self.metrics.count("db_rows_dropped")
+        return True
+
+    def _keep(self, messages):
+        """
+        Put messages back in front of the buffer, for the next flush
+        """
+        with self.pending_lock:
+            self.pending[:0] = messages
+
+    def close(self):
+        self.closed = True
+        self.flush_needed.set()
+        self.flusher.join()
+        self.flush()
+        self.conn.close()
+        if self.search_conn:
+            with self.search_lock:
+                self.search_conn.close()
+
+    def select_rows(self, **kwargs):
+        """
+        Rows of the messages table in (timestamp, id) order. Keyword arguments:
+
+        n               only the first n rows (all if 0)
+        last            the last n rows instead of the first ones
+        from_timestamp  only messages newer than this datetime
+        username        only messages of this user
+        channel         only messages of this channel
+        after, before   keyset pagination: only rows strictly after or before
+                        the (timestamp, id) of a row of a previous page
+        """
         n = kwargs.get('n', 0)
+        last = kwargs.get('last', False)
         from_timestamp = kwargs.get('from_timestamp', None)
-        query = "SELECT content FROM messages "
+        username = kwargs.get('username', None)
+        channel = kwargs.get('channel', None)
+        after = kwargs.get('after', None)
+        before = kwargs.get('before', None)
+        self.flush()
+        query = f"SELECT {MESSAGE_COLUMNS} FROM messages"
+        conditions = []
         params = []
         if from_timestamp:
             assert type(from_timestamp) is datetime
-            query += " WHERE timestamp > ?"
-            params.append(from_timestamp.timestamp())
-        query += " ORDER BY timestamp"
+            conditions.append("timestamp > ?")
+            params.append(to_epoch_us(from_timestamp))
+        if username is not None:
+            conditions.append("username = ?")
+            params.append(username)
+        if channel is not None:
+            conditions.append("channel = ?")
+            params.append(channel)
+        if after:
+            conditions.append("(timestamp, id) > (?, ?)")
+            params += after
+        if before:
+            conditions.append("(timestamp, id) < (?, ?)")
+            params += before
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        if last:
+            query += " ORDER BY timestamp DESC, id DESC"
+        else:
+            query += " ORDER BY timestamp, id"
         if n > 0:
             query += " LIMIT ?"
             params.append(n)
         query += ";"
-        rows = self.exec_query(query,params)
-        return [Message(payload = json.loads(row[0])) for row in rows]
+        rows = self.exec_query(query, params)
+        if last:
+            rows.reverse()
+        return rows
+
+    def select_messages(self, **kwargs):
+        """
+        Messages selected with the same arguments as select_rows
+        """
+        return [row_message(row) for row in self.select_rows(**kwargs)]
+
+    def search(self, text, **kwargs):
+        """
+        Page of the messages that match fts_query(text), best ranked first,
+        and whether there are more. Scoring every match of a common word
+        would take long, so only the newest SEARCH_WINDOW are ranked.
+        Keyword arguments:
+
+        username        only messages of this user
+        channel         only messages of this channel
+        since, until    only messages in this range of epoch microseconds
+        page            the page to return, of page_size results
+        """
+        if not self.search_conn:
+            raise ValueError("Search is not available in this server")
+        username = kwargs.get('username', None)
+        channel = kwargs.get('channel', None)
+        since = kwargs.get('since', 0)
+        until = kwargs.get('until', 0)
+        page = max(kwargs.get('page', 0), 0)
+        page_size = kwargs.get('page_size', SEARCH_PAGE)
+        self.flush()
+        matches = """FROM messages_fts
+                JOIN messages ON messages.id = messages_fts.rowid
+                WHERE messages_fts MATCH ?"""
+        match = fts_query(text)
+        params = []
+        # The phrase in the index also matches longer names, hence the join
+        if username:
+            match += f" AND username : {fts_phrase(username)}"
+            matches += " AND messages.username = ?"
+            params.append(username)
+        if channel:
+            match += f" AND channel : {fts_phrase(channel)}"
+            matches += " AND messages.channel = ?"
+            params.append(channel)
+        params.insert(0, match)
+        if since:
+            matches += " AND messages.timestamp >= ?"
+            params.append(since)
+        if until:
+            matches += " AND messages.timestamp < ?"
+            params.append(until)
+        with self.search_lock:
+            try:
+                if since or until:
+                    # The rows of the time range, found with messages_timestamp,
+                    # bound the rowids FTS5 has to walk
+                    first, last = self.search_conn.execute("""SELECT min(id),
+                            max(id) FROM messages WHERE timestamp >= ?
+                            AND timestamp < ?;""",
+                            (since, until or 2**63 - 1)).fetchone()
+                    matches += " AND messages_fts.rowid BETWEEN ? AND ?"
+                    params += [first or 0, last or 0]
+                # Walking the matches by rowid doesn't score them
+                oldest = self.search_conn.execute(f"""SELECT messages_fts.rowid
+                        {matches} ORDER BY messages_fts.rowid DESC
+                        LIMIT 1 OFFSET ?;""", params + [SEARCH_WINDOW - 1]).fetchall()
+                if oldest:
+                    matches += " AND messages_fts.rowid >= ?"
+                    params.append(oldest[0][0])
+                # One more row than asked for, to know if there are more
+                rows = self.search_conn.execute(f"""SELECT {SEARCH_COLUMNS}
+                        {matches} ORDER BY messages_fts.rank LIMIT ? OFFSET ?;""",
+                        params + [page_size + 1, page * page_size]).fetchall()
+            except sqlite3.Error as e:
+                print("sqlite3.Error:",e)
+                rows = []
+        return [row_message(row) for row in rows[:page_size]], len(rows) > page_size
 
     def create_tables(self):
+        self.migrate()
         self.create_messages()
         self.create_users()
+        self.exec_query(f"PRAGMA user_version = {SCHEMA_VERSION};")
+
+    def migrate(self):
+        """
+        Bring a database created by an older version of the server up to
+        SCHEMA_VERSION.
+        """
+        version = self.exec_query("PRAGMA user_version;")[0][0]
+        columns = self._message_columns()
+        if version < 1 and 'content' in columns:
+            self._migrate_json_messages()
+            columns = self._message_columns()
+        if version < 2 and columns and 'channel' not in columns:
+            # Version 1 had no channels, everything was said in the default one
+            self.exec_query(f"""ALTER TABLE messages ADD COLUMN channel text
+                    NOT NULL DEFAULT '{DEFAULT_CHANNEL}';""")
+
+    def _message_columns(self):
+        return [row[1] for row in self.exec_query("PRAGMA table_info(messages);")]
+
+    def _migrate_json_messages(self):
+        """
+        Version 0 stored every message as a JSON blob in a content column.
+        The migration is a single transaction: if any message can't be
+        converted the database is left as it was and the server doesn't
+        start.
+        """
+        print("Migrating messages table to typed columns")
+        with self.lock:
+            try:
+                # DDL doesn't open a transaction by itself in sqlite3
+                self.conn.execute("BEGIN;")
+                self.conn.execute("ALTER TABLE messages RENAME TO messages_v0;")
+                for query in CREATE_MESSAGES:
+                    self.conn.execute(query)
+                old = self.conn.execute("SELECT content FROM messages_v0 ORDER BY id;")
+                rows = (message_row(Message(payload = json.loads(content)))
+                        for content, in old)
+                self.conn.executemany(INSERT_MESSAGE, rows)
+                self.conn.execute("DROP TABLE messages_v0;")
+                self.conn.execute("PRAGMA user_version = 1;")
+                self.conn.commit()
+            except Exception as e:
+                self.conn.rollback()
+                print("Migration failed, the database was not changed:", repr(e))
+                raise
+
+    def create_search_index(self):
+        """
+        Create the full text index of the messages and the triggers that
+        keep it up to date, indexing the messages stored before it existed.
+        False if this SQLite was built without FTS5.
+        """
+        with self.lock:
+            try:
+                existed = self.conn.execute("""SELECT 1 FROM sqlite_master
+                        WHERE name = 'messages_fts';""").fetchall()
+                self.conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS
+                        messages_fts USING fts5(body, username, channel,
+                        content='messages', content_rowid='id',
+                        tokenize='unicode61 remove_diacritics 2');""")
+                self.conn.execute("""CREATE TRIGGER IF NOT EXISTS messages_fts_insert
+                        AFTER INSERT ON messages BEGIN
+                        INSERT INTO messages_fts(rowid, body, username, channel)
+                        VALUES (new.id, new.body, new.username, new.channel);
+                        END;""")
+                self.conn.execute("""CREATE TRIGGER IF NOT EXISTS messages_fts_delete
+                        AFTER DELETE ON messages BEGIN
+                        INSERT INTO messages_fts(messages_fts, rowid, body,
+                        username, channel) VALUES ('delete', old.id, old.body,
+                        old.username, old.channel);
+                        END;""")
+                if not existed:
+                    self.conn.execute("""INSERT INTO messages_fts(messages_fts)
+                            VALUES ('rebuild');""")
+                self.conn.commit()
+                return True
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                print("sqlite3.Error:",e)
+                return False
 
     def create_messages(self):
-        self.exec_query("""CREATE TABLE IF NOT EXISTS messages (
-                id integer PRIMARY KEY,
-                timestamp real NOT NULL,
-                content text NOT NULL
-                );""")
+        for query in CREATE_MESSAGES:
+            self.exec_query(query)
 
     def create_users(self):
         self.exec_query("""CREATE TABLE IF NOT EXISTS users (
@@ -218,13 +1224,41 @@ def main():
                         help="server ip", type=str)
     parser.add_argument("-p", metavar="port", default=6000,
                         help="server port", type=int)
+    parser.add_argument("-e", metavar="engine", default="process",
+                        choices=["process", "async", "sharded"],
+                        help="process per client, single asyncio event loop or"
+                        " an asyncio event loop per shard process")
+    parser.add_argument("-k", metavar="shards", default=None,
+                        help="shards of the sharded engine, one per core by default",
+                        type=int)
+    parser.add_argument("-l", metavar="log", default="all",
+                        choices=ConsoleLog.MODES,
+                        help="print every message, a sample of them or none")
+    parser.add_argument("--outbox", metavar="frames", default=OUTBOX_SIZE,
+                        help="frames buffered for a client that isn't reading",
+                        type=int)
+    parser.add_argument("--policy", metavar="policy", default="disconnect",
+                        choices=SLOW_POLICIES,
+                        help="what to do when the buffer of a client is full:"
+                        " disconnect, drop_oldest or coalesce")
     args = parser.parse_args()
+    if args.outbox < OUTBOX_MIN:
+        parser.error(f"--outbox must be at least {OUTBOX_MIN}: an evicted client"
+                     " needs room for its ERROR and the close")
+    options = { "log" : args.l, "outbox_size" : args.outbox, "policy" : args.policy }
     if args.i == "all":
         args.i = "0.0.0.0"
     elif args.i == "auto":
         import urllib.request
         args.i = urllib.request.urlopen('https://ident.me').read().decode('utf8')
-    server = ChatServer(args.i, args.p)
+    if args.e == "async":
+        from server_async import AsyncChatServer
+        server = AsyncChatServer(args.i, args.p, **options)
+    elif args.e == "sharded":
+        from server_sharded import ShardedChatServer
+        server = ShardedChatServer(args.i, args.p, shards=args.k, **options)
+    else:
+        server = ChatServer(args.i, args.p, **options)
     try:
         server.start()
     except KeyboardInterrupt:
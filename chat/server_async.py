@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+from multiprocessing.connection import Listener
+from multiprocessing import AuthenticationError
+from threading import Thread
+from collections import deque
+from time import perf_counter
+import asyncio, os, pickle, socket, struct
+
+from messages import *
+from server import ChatServer, OUTBOX_SIZE, BATCH_WINDOW, EVICT_GRACE,\
+        collect_frames, coalesce, backlog_item, take_all
+
+class StreamConnection():
+    """
+    asyncio counterpart of multiprocessing.connection.Connection. It speaks
+    the same length prefixed framing, so clients don't notice the difference.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def send_bytes(self, buf):
+        n = len(buf)
+        if n > 0x7fffffff:
+            header = struct.pack("!i", -1) + struct.pack("!Q", n)
+        else:
+            header = struct.pack("!i", n)
+        if n > 16384:
+            # Don't copy large frames, they may be shared by many connections
+            self.writer.write(header)
+            self.writer.write(buf)
+        else:
+            self.writer.write(header + buf)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def send(self, obj):
+        self.send_bytes(pickle.dumps(obj))
+
+    async def recv_bytes(self):
+        try:
+            size, = struct.unpack("!i", await self.reader.readexactly(4))
+            if size == -1:
+                size, = struct.unpack("!Q", await self.reader.readexactly(8))
+            return await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            raise EOFError
+
+    async def recv(self):
+        return pickle.loads(await self.recv_bytes())
+
+    def close(self):
+        self.writer.close()
+
+class AsyncChatServer(ChatServer):
+    """
+    ChatServer engine that multiplexes every client connection on a single
+    asyncio event loop instead of starting one process per client.
+
+    Connections are accepted (and authenticated) by the standard Listener in
+    a separate thread and then handed over to the event loop.
+    """
+
+    def __init__(self, ip="127.0.0.1", port=6000, authkey=b"secret password",
+            log="all", backlog=128, outbox_size=OUTBOX_SIZE, policy="disconnect"):
+        self.loop = None
+        self.backlog = backlog
+        self.handshakes = set() # The loop only keeps weak references to tasks
+        super().__init__(ip, port, authkey, log, outbox_size, policy)
+
+    def start(self):
+        try:
+            self.listener = Listener(address=self.addr, authkey=self.authkey,
+                    backlog=self.backlog)
+        except OSError as e:
+            print(e)
+        else:
+            ip, port = self.addr
+            print(f"Server listening on {ip}:{port}")
+            self.loop = asyncio.new_event_loop()
+            acceptor = Thread(target=self._accept_loop, name="acceptor")
+            acceptor.daemon = True
+            acceptor.start()
+            self.loop.run_forever()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+                client_ip = self.listener.last_accepted[0]
+            except AuthenticationError as e:
+                print("Authentication error")
+                continue
+            except OSError:
+                break
+            nodelay(conn)
+            sock = socket.socket(fileno=os.dup(conn.fileno()))
+            conn.close()
+            self.loop.call_soon_threadsafe(self._start_listen, sock, client_ip)
+
+    def _start_listen(self, sock, client_ip, frame = None):
+        # Until the client is registered nothing else refers to its task, so
+        # it could be garbage collected in the middle of the handshake
+        task = self.loop.create_task(self._listen(sock, client_ip, frame))
+        self.handshakes.add(task)
+        task.add_done_callback(self.handshakes.discard)
+
+    async def _listen(self, sock, client_ip, frame = None):
+        """
+        Handshake of a new connection. frame is its CONNECT frame if it was
+        already read by whoever accepted the connection.
+        """
+        reader, writer = await asyncio.open_connection(sock=sock)
+        conn = StreamConnection(reader, writer)
+        username = None
+        start = perf_counter()
+        try:
+            if frame is None:
+                frame = await conn.recv_bytes()
+            message = decode_frame(frame)
+            assert message.type == CONNECT,\
+                "First message must be of type CONNECT"
+            username = self.connect(message, client_ip, conn)
+            self.metrics.observe("handshake", perf_counter() - start)
+        except EOFError as eof:
+            print("Error receiving connection message.")
+            conn.close()
+        except (AssertionError, ValueError) as e:
+            print(e)
+            conn.close()
+        if username:
+            session = self.clients[username]["session"]
+            await self._client_loop(username, session, conn)
+
+    async def _client_loop(self, username, session, conn):
+        while self._is_current(username, session):
+            try:
+                frame = await conn.recv_bytes()
+            except Exception as e:
+                if type(e) is EOFError:
+                    print(f"Connection down :(")
+                else:
+                    print(f"Error: {e}")
+                self.client_close(username, session)
+            else:
+                self._parse_payload(username, frame, session)
+                await asyncio.sleep(0) # Let the writers drain
+
+    def _open_outbox(self, username, conn, wire, compress):
+        queue = asyncio.Queue(self.outbox_size)
+        backlog = deque()
+        writer = self.loop.create_task(
+                self._write_loop(username, conn, queue, backlog, wire, compress))
+        return { "conn" : conn, "queue" : queue, "backlog" : backlog,
+                 "writer" : writer }
+
+    async def _write_loop(self, username, conn, queue, backlog, wire, compress):
+        closing = False
+        while not closing:
+            item = backlog_item(backlog) if queue.empty() else None
+            items = [item or await queue.get()]
+            if items[0] is None:
+                break
+            if wire >= 2:
+                await asyncio.sleep(BATCH_WINDOW)
+                closing = collect_frames(queue, items)
+            try:
+                conn.send_bytes(coalesce(items, wire, compress))
+                await conn.drain()
+            except Exception as e:
+                print(f"Error sending to {username}: {e}")
+                break
+            self._sent(items)
+        conn.close()
+
+    def _close_outbox(self, outbox):
+        try:
+            outbox["queue"].put_nowait(None)
+        except asyncio.QueueFull:
+            self._abort_outbox(outbox)
+
+    def _abort_outbox(self, outbox):
+        if not outbox["writer"].done():
+            outbox["writer"].cancel()
+            # The writer may be stuck in drain with the ERROR of an eviction
+            # still queued. It goes after the frames the transport buffers.
+            for item in take_all(outbox["queue"]):
+                if item is not None:
+                    outbox["conn"].send_bytes(item[0])
+            outbox["conn"].close()
+
+    def _call_soon(self, function, *args):
+        self.loop.call_soon_threadsafe(function, *args)
+
+    def _abort_later(self, outbox):
+        self.loop.call_later(EVICT_GRACE, self._abort_outbox, outbox)
+
+    def stop(self):
+        if self.listener:
+            self.listener.close()
+        super().stop()
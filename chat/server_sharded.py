@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+from multiprocessing.connection import Listener, wait
+from multiprocessing import Process, Pipe, AuthenticationError, reduction
+from threading import Thread
+from collections import OrderedDict, deque
+from time import monotonic
+import asyncio, os, signal, socket, zlib
+
+from messages import *
+from server import ServerData, HISTORY_SIZE, OUTBOX_SIZE, FLUSH_INTERVAL
+from server_async import AsyncChatServer
+
+HANDSHAKE_TIMEOUT = 5 # Seconds the acceptor waits for the CONNECT frame
+SHUTDOWN_TIMEOUT = 5 # Seconds a shard has to flush its database on stop
+UNFLUSHED_TIME = 10 * FLUSH_INTERVAL # Seconds another shard may not have
+                                     # stored a message it broadcast
+
+def shard_of(username, shards):
+    """
+    Shard that serves a user. Unlike hash() of a str it is the same in
+    every process and every run.
+    """
+    return zlib.crc32(username.encode()) % shards
+
+class ShardChatServer(AsyncChatServer):
+    """
+    Worker process of a ShardedChatServer. It runs the asyncio engine for
+    the clients the acceptor hands over through handoff, and exchanges
+    broadcasts with the other shards through the bus: a pipe from every
+    shard to every other one.
+
+    A broadcast is published once, encoded for WIRE_VERSION, and the other
+    shards reuse that frame for their clients of the same version. Only the
+    shard the message was sent to stores it in the database, the others
+    just add it to their history of the channel. The history of a channel
+    without local subscribers is forgotten as usual. Its remote messages
+    of the last UNFLUSHED_TIME seconds, up to HISTORY_SIZE, are kept in
+    self.unflushed instead, because the database may not have them yet
+    when the history is loaded again.
+    """
+
+    def __init__(self, index, handoff, bus_in, bus_out, log="all",
+            outbox_size=OUTBOX_SIZE, policy="disconnect"):
+        self.index = index
+        self.handoff = handoff
+        self.bus_in = bus_in
+        self.bus_out = bus_out
+        self.unflushed = OrderedDict() # channel: deque of (received, message)
+        super().__init__(log=log, outbox_size=outbox_size, policy=policy)
+        self.metrics.gauge("shard", lambda: self.index)
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        for target, name in ((self._handoff_loop, "handoff"),
+                             (self._bus_loop, "bus")):
+            thread = Thread(target=target, name=f"shard {self.index} {name}")
+            thread.daemon = True
+            thread.start()
+        self.loop.run_forever()
+
+    def _handoff_loop(self):
+        """
+        Receives the accepted connections, with their client ip and CONNECT
+        frame, until the acceptor sends None.
+        """
+        while True:
+            try:
+                handoff = self.handoff.recv()
+                if handoff is None:
+                    break
+                fd = reduction.recv_handle(self.handoff)
+            except (EOFError, OSError):
+                break
+            client_ip, frame = handoff
+            sock = socket.socket(fileno=fd)
+            self.loop.call_soon_threadsafe(self._start_listen, sock,
+                                           client_ip, frame)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def _bus_loop(self):
+        peers = list(self.bus_in)
+        while peers:
+            for conn in wait(peers):
+                frames = []
+                try:
+                    # Whatever is waiting is delivered in a single callback
+                    while True:
+                        frames.append(conn.recv_bytes())
+                        if not conn.poll():
+                            break
+                except (EOFError, OSError):
+                    peers.remove(conn)
+                if frames:
+                    self.loop.call_soon_threadsafe(self._deliver_remote, frames)
+
+    def _deliver_remote(self, frames):
+        for frame in frames:
+            message = decode_frame(frame)
+            if message.type == MESSAGE:
+                channel = message.get('channel')
+                if channel in self.histories:
+                    self.remember(message)
+                else:
+                    self._keep_unflushed(channel, message)
+            self.deliver(message, frames = {WIRE_VERSION : frame})
+        self.metrics.count("bus_in", len(frames))
+
+    def _keep_unflushed(self, channel, message):
+        now = monotonic()
+        recent = self.unflushed.pop(channel, None) or deque(maxlen = HISTORY_SIZE)
+        recent.append((now, message))
+        self.unflushed[channel] = recent # Most recently used last
+        # The channels with nothing left that recent go first
+        while self.unflushed:
+            channel, recent = next(iter(self.unflushed.items()))
+            if recent[-1][0] > now - UNFLUSHED_TIME:
+                break
+            del self.unflushed[channel]
+
+    def channel_history(self, channel):
+        loaded = channel not in self.histories
+        history = super().channel_history(channel)
+        recent = self.unflushed.pop(channel, None)
+        if loaded and recent:
+            stored = history.latest(HISTORY_SIZE)
+            oldest = stored[0].epoch_us if stored else 0
+            stored = set(map(message_key, stored))
+            deadline = monotonic() - UNFLUSHED_TIME
+            for received, message in recent:
+                # Older ones are stored already, or outside the history
+                if received > deadline and message.epoch_us >= oldest\
+                        and message_key(message) not in stored:
+                    history.add(message)
+        return history
+
+    def broadcast_message(self, message, excluded_users = []):
+        frames = super().broadcast_message(message, excluded_users)
+        if WIRE_VERSION not in frames:
+            frames[WIRE_VERSION] = encode_frame(message, WIRE_VERSION)
+        for peer in list(self.bus_out):
+            try:
+                peer.send_bytes(frames[WIRE_VERSION])
+            except OSError:
+                self.bus_out.remove(peer) # The shard is gone
+        self.metrics.count("bus_out")
+        return frames
+
+def message_key(message):
+    """
+    What tells a chat message apart from the rest
+    """
+    return (message.epoch_us, message.get('username'), message.get('message'))
+
+def run_shard(index, handoff, bus_in, bus_out, log, outbox_size, policy):
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # The acceptor stops the shards
+    server = ShardChatServer(index, handoff, bus_in, bus_out, log,
+                             outbox_size, policy)
+    server.start()
+    server.stop()
+
+class ShardedChatServer():
+    """
+    Chat server spread over several processes, so that broadcasts use more
+    than one core. This process only accepts and authenticates connections
+    and reads their CONNECT frame. The socket is then passed to the shard
+    given by shard_of(username), a ShardChatServer, so a user is always
+    served by the same shard and usernames can be checked locally.
+
+    Metrics are kept per shard: a STATS message is answered by the shard of
+    the client that sends it.
+    """
+
+    def __init__(self, ip="127.0.0.1", port=6000, authkey=b"secret password",
+            log="all", shards=None, backlog=128, outbox_size=OUTBOX_SIZE,
+            policy="disconnect"):
+        self.addr = (ip, int(port))
+        self.authkey = authkey
+        self.log = log
+        self.outbox_size = outbox_size
+        self.policy = policy
+        self.n_shards = shards or os.cpu_count()
+        self.backlog = backlog
+        self.listener = None
+        self.shards = []
+        self.handoffs = []
+
+    def start(self):
+        # Created or migrated here, before the shards share it
+        ServerData().close()
+        # Started first, so that they don't inherit the listening socket
+        self._start_shards()
+        try:
+            self.listener = Listener(address=self.addr, authkey=self.authkey,
+                    backlog=self.backlog)
+        except OSError as e:
+            print(e)
+        else:
+            ip, port = self.addr
+            print(f"Server listening on {ip}:{port} with {self.n_shards} shards")
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            while self._accept():
+                pass
+
+    def _start_shards(self):
+        # pipes[i][j] carries the broadcasts of shard i to shard j
+        pipes = [[Pipe(duplex=False) if i != j else None
+                  for j in range(self.n_shards)] for i in range(self.n_shards)]
+        for i in range(self.n_shards):
+            handoff, shard_handoff = Pipe() # A socket, it can carry descriptors
+            bus_in = [pipes[j][i][0] for j in range(self.n_shards) if j != i]
+            bus_out = [pipes[i][j][1] for j in range(self.n_shards) if j != i]
+            shard = Process(target=run_shard, name=f"shard {i}",
+                    args=(i, shard_handoff, bus_in, bus_out, self.log,
+                          self.outbox_size, self.policy))
+            shard.daemon = True
+            shard.start()
+            shard_handoff.close()
+            self.shards.append(shard)
+            self.handoffs.append(handoff)
+        for row in pipes:
+            for pipe in row:
+                if pipe:
+                    pipe[0].close()
+                    pipe[1].close()
+
+    def _accept(self):
+        """
+        Accept a connection and hand it over to its shard. False once the
+        listener is closed.
+        """
+        try:
+            conn = self.listener.accept()
+            client_ip = self.listener.last_accepted[0]
+        except AuthenticationError as e:
+            print("Authentication error")
+            return True
+        except (EOFError, ConnectionError) as e:
+            return True
+        except OSError:
+            return False
+        nodelay(conn)
+        try:
+            if not conn.poll(HANDSHAKE_TIMEOUT):
+                raise EOFError
+            frame = conn.recv_bytes()
+            message = decode_frame(frame)
+            assert message.type == CONNECT,\
+                "First message must be of type CONNECT"
+        except EOFError as eof:
+            print("Error receiving connection message.")
+        except (AssertionError, ValueError) as e:
+            print(e)
+        except Exception as e:
+            # A single bad client must not take down every shard
+            print("Error reading connection message:", repr(e))
+        else:
+            shard = shard_of(message.get('username'), self.n_shards)
+            handoff = self.handoffs[shard]
+            try:
+                handoff.send((client_ip, frame))
+                reduction.send_handle(handoff, conn.fileno(), self.shards[shard].pid)
+            except OSError as e:
+                print(f"Shard {shard} is gone:", e)
+        conn.close()
+        return True
+
+    def stop(self):
+        if self.listener:
+            self.listener.close()
+        for handoff in self.handoffs:
+            try:
+                handoff.send(None)
+            except OSError:
+                pass
+        for shard in self.shards:
+            shard.join(SHUTDOWN_TIMEOUT)
+            if shard.is_alive():
+                shard.terminate()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Malformed frames must be rejected with a ValueError, which is what the
+servers catch while reading a CONNECT. Run with python3 -m unittest from
+this directory.
+"""
+import pickle, unittest
+
+from messages import *
+
+def sample_frames():
+    connect = Message(type=CONNECT, username="ana")
+    chat = Message(type=MESSAGE, username="ana", message="hola", channel="dev")
+    history = MessageHistory(messages = [chat, chat])
+    return [encode_frame(connect, WIRE_VERSION),
+            encode_frame(chat, WIRE_VERSION),
+            encode_frame(Message(type=MESSAGE_HISTORY, history=history), WIRE_VERSION),
+            encode_batch([encode_frame(chat, WIRE_VERSION)] * 2, WIRE_VERSION)]
+
+class TestTruncatedFrames(unittest.TestCase):
+
+    def test_every_prefix(self):
+        for frame in sample_frames():
+            decode_frame(frame)
+            for n in range(len(frame)):
+                with self.assertRaises(ValueError, msg=f"{frame[:n]!r}"):
+                    # Also decodes the lazy messages of a history
+                    unpack_messages(decode_frame(frame[:n]))
+
+    def test_short_connect(self):
+        with self.assertRaises(ValueError):
+            decode_frame(b'\xc7\x04\x01')
+
+    def test_truncated_string(self):
+        body = "hola"
+        message = Message(type=MESSAGE, username="ana", message=body)
+        frame = encode_frame(message, WIRE_VERSION)
+        end = frame.index(body.encode()) + len(body)
+        with self.assertRaises(ValueError):
+            decode_frame(frame[:end - 2]) # Cut inside the body
+
+    def test_malformed_pickle(self):
+        for frame in (b'', b'garbage', pickle.dumps(3), pickle.dumps({})):
+            with self.assertRaises(ValueError):
+                decode_frame(frame)
+
+class TestPayloads(unittest.TestCase):
+
+    def test_lone_surrogate(self):
+        # A pickle can carry it, but it couldn't be sent in a binary frame
+        payload = Message(type=MESSAGE, username="ana", message="hola").encode()
+        payload['message'] = "bad \ud800"
+        with self.assertRaises(ValueError):
+            decode_frame(pickle.dumps(payload))
+
+if __name__ == "__main__":
+    unittest.main()